@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from itertools import chain
+
+from dessert.nlp import IngredientProcessor, missing_resources
+from dessert.query import IngredientIndex, bigrams, jaccard
+from dessert.query.similarity import BigramSimilarity
+from dessert.wiki import SqliteWikitextCache, WikiPage, WikiParser, WikiSource
+from dessert.wiki.fakewiki import FakeMediaWiki, write_pages
+from main import filterDessertByMandatoryIngredients
+
+from .corpus import generate_corpus, load_corpus, save_corpus, snapshot_cache
+from .harness import compare_to_baseline, count_ingredients, measure
+
+# Offline benchmarks of the fetch, parse, normalize and filter stages
+# Fetching is measured against a local FakeMediaWiki serving the corpus.
+# Run from the project folder:
+#   python -m benchmarks                          generated corpus of 500 pages
+#   python -m benchmarks --corpus snapshot.json.gz
+#   python -m benchmarks --save baseline.json
+#   python -m benchmarks --baseline baseline.json --threshold 0.1
+
+
+def bench_fetch(corpus, args) -> dict:
+    # Cold cache fetch from a local fake MediaWiki with simulated latency
+    stages = {}
+    titles = [title for title, _ in corpus]
+    with tempfile.TemporaryDirectory() as tmp:
+        write_pages(os.path.join(tmp, "pages"), corpus)
+        with FakeMediaWiki(os.path.join(tmp, "pages"), latency=args.fetch_latency,
+                           max_response_bytes=args.fetch_max_response_bytes) as wiki:
+            for concurrency in args.fetch_concurrency:
+                cache = SqliteWikitextCache(os.path.join(tmp, "wikitext-%d.db" % concurrency))
+                ws = WikiSource(concurrency=concurrency, cache=cache, api_url=wiki.url)
+                start_count = wiki.request_count
+                result, _ = measure("fetch-c%d" % concurrency, [titles],
+                                    lambda batch: list(chain.from_iterable(ws.iter_dessert_wikitexts(batch))),
+                                    pages_of=len, memory=False)
+                result.notes.append("%d request(s), %.0f ms latency per request"
+                                    % (wiki.request_count - start_count, args.fetch_latency * 1000.0))
+                stages[result.name] = result
+                cache.close()
+    return stages
+
+
+def bench_cache_read(corpus, args) -> dict:
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SqliteWikitextCache(os.path.join(tmp, "wikitext.db"))
+        cache.put_many([(title, title, wikitext, 1, "") for title, wikitext in corpus])
+        ws = WikiSource(cache=cache)
+        titles = [title for title, _ in corpus]
+        batches = [titles[i:i+50] for i in range(0, len(titles), 50)]
+        result, _ = measure("cache-read", batches,
+                            lambda batch: list(chain.from_iterable(ws.iter_dessert_wikitexts(batch))),
+                            pages_of=len, memory=args.memory)
+        result.notes.append("latency per 50 page batch")
+        stages[result.name] = result
+        cache.close()
+    return stages
+
+
+def bench_parse(pages, args) -> (dict, list):
+    stages = {}
+    outputs = {}
+    for engine in WikiParser.ENGINES:
+        parser = WikiParser(engine=engine)
+        result, parsed = measure("parse-%s" % engine, pages, parser.get_dessert_ingredients,
+                                 ingredients_of=count_ingredients, memory=args.memory)
+        stages[result.name] = result
+        outputs[engine] = parsed
+    # The engines must agree
+    reference = outputs[WikiParser.ENGINES[0]]
+    for engine, parsed in outputs.items():
+        mismatches = sum(1 for a, b in zip(reference, parsed) if a != b)
+        stages["parse-%s" % engine].notes.append("%d page(s) differ from %s" % (mismatches, WikiParser.ENGINES[0]))
+    return stages, reference
+
+
+def bench_normalize(desserts, args) -> (dict, list):
+    processor = IngredientProcessor()
+    result, normalized = measure("normalize", [ingredients for _, ingredients in desserts],
+                                 processor.normalize_ingredients, ingredients_of=count_ingredients,
+                                 memory=args.memory)
+    stats = processor.memo_stats()["normalize"]
+    result.notes.append("memo hits %d, misses %d" % (stats["hits"], stats["misses"]))
+    return {result.name: result}, [(title, n) for (title, _), n in zip(desserts, normalized)], processor
+
+
+def bench_filter(desserts, lemmatize, args) -> dict:
+    stages = {}
+    names = sorted({i.name for _, ingredients in desserts for i in ingredients if len(i.name) > 2})
+    rng = random.Random(args.seed)
+    queries = [rng.sample(names, min(len(names), rng.randint(1, 3))) for _ in range(args.queries)]
+
+    def sim_query(terms):
+        return [title for title, ingredients in desserts
+                if filterDessertByMandatoryIngredients(terms, ingredients, lemmatize)]
+
+    result, sim_results = measure("filter-sim", queries, sim_query, memory=args.memory)
+    result.notes.append("pages = queries, full rescan per query")
+    stages[result.name] = result
+
+    index = IngredientIndex(key=lemmatize)
+    result, _ = measure("index-build", desserts, lambda d: index.add(*d), memory=False)
+    stages[result.name] = result
+
+    result, index_results = measure("filter-index", queries,
+                                    lambda terms: [title for title, _ in index.query(terms)], memory=args.memory)
+    mismatches = sum(1 for a, b in zip(sim_results, index_results) if a != b)
+    result.notes.append("pages = queries, %d query result(s) differ from filter-sim" % mismatches)
+    stages[result.name] = result
+
+    # All query terms against all distinct indexed names, pair by pair and as one sparse product
+    terms = sorted({term.lower() for terms in queries for term in terms})
+    keys = sorted({lemmatize(i.name) for _, ingredients in desserts for i in ingredients})
+
+    def pairwise(_):
+        return [[name for name in keys if jaccard(bigrams(term), bigrams(name)) > 0.5] for term in terms]
+
+    def batch(_):
+        similarity = BigramSimilarity(keys)
+        return [sorted(keys[i] for i, _ in matches) for matches in similarity.matches(terms, 0.5)]
+
+    result, pairwise_results = measure("similarity-pairwise", [None], pairwise, pages_of=lambda _: len(terms),
+                                       memory=False)
+    result.notes.append("pages = terms, %d terms x %d names" % (len(terms), len(keys)))
+    stages[result.name] = result
+    result, batch_results = measure("similarity-batch", [None], batch, pages_of=lambda _: len(terms),
+                                    memory=args.memory)
+    result.notes.append("pages = terms, %d term(s) differ from similarity-pairwise"
+                        % sum(1 for a, b in zip(pairwise_results[0], batch_results[0]) if a != b))
+    stages[result.name] = result
+    return stages
+
+
+def print_results(results: dict):
+    print("%-20s %8s %12s %14s %9s %9s %9s %10s"
+          % ("stage", "pages", "pages/s", "ingredients/s", "p50 ms", "p90 ms", "p99 ms", "peak KiB"))
+    for name, r in results.items():
+        peak = "%10.0f" % r["peak_memory_kib"] if r["peak_memory_kib"] is not None else "%10s" % "-"
+        print("%-20s %8d %12.1f %14.1f %9.3f %9.3f %9.3f %s"
+              % (name, r["pages"], r["pages_per_s"], r["ingredients_per_s"],
+                 r["p50_ms"], r["p90_ms"], r["p99_ms"], peak))
+        for note in r["notes"]:
+            print("    %s" % note)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline dessert pipeline benchmarks")
+    parser.add_argument("--corpus", metavar="PATH", help="snapshot file to use instead of a generated corpus")
+    parser.add_argument("--pages", type=int, default=500, help="size of the generated corpus")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated corpus and queries")
+    parser.add_argument("--queries", type=int, default=50, help="number of filter queries")
+    parser.add_argument("--write-corpus", metavar="PATH", help="write the generated corpus to a snapshot file")
+    parser.add_argument("--snapshot-cache", metavar="CACHE",
+                        help="write the pages of a wikitext cache to the --write-corpus snapshot and exit")
+    parser.add_argument("--fetch-latency", type=float, default=0.02,
+                        help="simulated latency of the fake MediaWiki in seconds")
+    parser.add_argument("--fetch-concurrency", type=int, nargs="+", default=[1, 4],
+                        help="fetch concurrency levels to measure")
+    parser.add_argument("--fetch-max-response-bytes", type=int, default=0,
+                        help="cut the fake MediaWiki responses after this much content (default: unlimited)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip peak memory measurement")
+    parser.add_argument("--save", metavar="PATH", help="save the results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare the throughput to saved results")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed throughput drop from the baseline (default: 0.1 = 10 %%)")
+    args = parser.parse_args()
+
+    if args.snapshot_cache:
+        if not args.write_corpus:
+            parser.error("--snapshot-cache needs --write-corpus")
+        print("Wrote %d pages" % snapshot_cache(args.snapshot_cache, args.write_corpus))
+        return 0
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = generate_corpus(args.pages, args.seed)
+        if args.write_corpus:
+            save_corpus(corpus, args.write_corpus)
+    print("Corpus: %d pages, %d chars" % (len(corpus), sum(len(wikitext) for _, wikitext in corpus)))
+
+    stages = {}
+    stages.update(bench_fetch(corpus, args))
+    stages.update(bench_cache_read(corpus, args))
+    pages = [WikiPage(title, wikitext) for title, wikitext in corpus]
+    parse_stages, parsed = bench_parse(pages, args)
+    stages.update(parse_stages)
+    desserts = [(page.title, ingredients) for page, ingredients in zip(pages, parsed) if len(ingredients) > 0]
+
+    if len(missing_resources()) == 0:
+        normalize_stages, desserts, processor = bench_normalize(desserts, args)
+        stages.update(normalize_stages)
+        lemmatize = processor.lemmatize
+    else:
+        print("NLTK resources missing, skipping the normalize stage and filtering without lemmatization")
+        lemmatize = str.lower
+    stages.update(bench_filter(desserts, lemmatize, args))
+
+    results = {name: stage.to_dict() for name, stage in stages.items()}
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print("Throughput regressions:")
+            for regression in regressions:
+                print("    %s" % regression)
+            return 1
+        print("No throughput regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
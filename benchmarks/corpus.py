@@ -0,0 +1,102 @@
+import gzip
+import json
+import random
+from typing import List, Tuple
+
+from dessert.wiki import SqliteWikitextCache
+
+# Building blocks of the generated dessert pages
+_INGREDIENTS = [
+    "sugar", "flour", "butter", "eggs", "milk", "cream", "almonds", "honey", "vanilla", "chocolate",
+    "cocoa", "rice", "cinnamon", "nutmeg", "gelatin", "yogurt", "cheese", "apples", "pears", "lemon",
+    "orange zest", "coconut milk", "condensed milk", "brown sugar", "walnuts", "pistachios", "raisins",
+    "dates", "semolina", "cornstarch", "baking powder", "yeast", "rose water", "cardamom", "saffron",
+    "strawberries", "raspberries", "blueberries", "bananas", "mascarpone", "ladyfingers", "espresso"
+]
+_QUALIFIERS = ["white", "brown", "salted", "unsalted", "whole", "skimmed", "ground", "fresh", "dried"]
+_WORDS = ("the dessert is made traditionally in many regions and is served cold or warm with a "
+          "variety of toppings which differ from country to country").split()
+
+
+def _ingredient(rng: random.Random) -> str:
+    name = rng.choice(_INGREDIENTS)
+    kind = rng.random()
+    if kind < 0.35:
+        return "[[%s]]" % name
+    if kind < 0.5:
+        return "[[%s|%s]]" % (name.capitalize(), name)
+    if kind < 0.6:
+        return "%s (%s, %s)" % (name, rng.choice(_QUALIFIERS), rng.choice(_QUALIFIERS))
+    if kind < 0.65:
+        return "%s {{convert|%d|g}}" % (name, rng.randint(1, 500))
+    if kind < 0.7:
+        return "%s<ref name=\"r%d\">Source %d</ref>" % (name, rng.randint(1, 9), rng.randint(1, 99))
+    return name
+
+
+def _main_ingredient(rng: random.Random) -> str:
+    items = [_ingredient(rng) for _ in range(rng.randint(2, 9))]
+    style = rng.random()
+    if style < 0.1:
+        return "{{flatlist|\n%s\n}}" % "\n".join("* %s" % i for i in items)
+    if style < 0.2:
+        return "{{ubl|%s}}" % "|".join(items)
+    if style < 0.35:
+        return "<br>".join(items)
+    # Join with commas and the occasional "and" / "or"
+    joined = items[0]
+    for item in items[1:]:
+        joined += rng.choice([", ", ", ", ", ", " and ", " or "]) + item
+    return joined
+
+
+def _body(rng: random.Random) -> str:
+    paragraphs = []
+    for _ in range(rng.randint(3, 20)):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(40, 120))]
+        # Sprinkle in some links and templates like in real articles
+        for _ in range(5):
+            words[rng.randrange(len(words))] = "[[%s]]" % rng.choice(_INGREDIENTS)
+        words[rng.randrange(len(words))] = "{{citation needed|date=May 2020}}"
+        paragraphs.append(" ".join(words).capitalize() + ".")
+    return "\n\n".join(paragraphs)
+
+
+def generate_corpus(pages: int = 500, seed: int = 1, infobox_ratio: float = 0.4) -> List[Tuple[str, str]]:
+    # Generates a deterministic corpus of (title, wikitext) dessert pages
+    # The same arguments always give the same corpus, so the results are comparable between runs.
+    rng = random.Random(seed)
+    corpus = []
+    for n in range(pages):
+        title = "Dessert %d" % n
+        parts = []
+        if rng.random() < infobox_ratio:
+            infobox = rng.choice(["Infobox food", "Infobox prepared food", "infobox food"])
+            parts.append("{{%s\n| name = %s\n| country = Somewhere\n| main_ingredient = %s\n}}"
+                         % (infobox, title, _main_ingredient(rng)))
+        parts.append("'''%s''' is a dessert." % title)
+        parts.append(_body(rng))
+        corpus.append((title, "\n".join(parts)))
+    return corpus
+
+
+def save_corpus(corpus: List[Tuple[str, str]], path: str):
+    # Snapshots are gzipped JSON lists of [title, wikitext]
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False)
+
+
+def load_corpus(path: str) -> List[Tuple[str, str]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [(title, wikitext) for title, wikitext in json.load(f)]
+
+
+def snapshot_cache(cache_path: str, path: str) -> int:
+    # Freezes the pages of a SQLite wikitext cache into a snapshot file
+    cache = SqliteWikitextCache(cache_path)
+    try:
+        corpus = cache.pages()
+    finally:
+        cache.close()
+    save_corpus(corpus, path)
+    return len(corpus)
@@ -0,0 +1,91 @@
+import time
+import tracemalloc
+from typing import Any, Callable, Iterable, List
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def count_ingredients(ingredients) -> int:
+    # Number of ingredient nodes in the trees
+    return sum(1 + count_ingredients(i.ingredients) for i in ingredients)
+
+
+class StageResult:
+
+    def __init__(self, name: str, pages: int, ingredients: int, seconds: float, latencies: List[float],
+                 peak_memory: int = None):
+        self.name = name
+        self.pages = pages
+        self.ingredients = ingredients
+        self.seconds = seconds
+        self.latencies = sorted(latencies)
+        self.peak_memory = peak_memory
+        self.notes = []
+
+    def to_dict(self) -> dict:
+        return {
+            "items": len(self.latencies),
+            "pages": self.pages,
+            "ingredients": self.ingredients,
+            "seconds": self.seconds,
+            "pages_per_s": self.pages / self.seconds if self.seconds > 0 else 0.0,
+            "ingredients_per_s": self.ingredients / self.seconds if self.seconds > 0 else 0.0,
+            "p50_ms": _percentile(self.latencies, 50) * 1000.0,
+            "p90_ms": _percentile(self.latencies, 90) * 1000.0,
+            "p99_ms": _percentile(self.latencies, 99) * 1000.0,
+            "peak_memory_kib": self.peak_memory / 1024.0 if self.peak_memory is not None else None,
+            "notes": self.notes
+        }
+
+
+def measure(name: str, items: Iterable[Any], fn: Callable[[Any], Any],
+            pages_of: Callable[[Any], int] = lambda item: 1,
+            ingredients_of: Callable[[Any], int] = lambda result: 0,
+            memory: bool = True) -> (StageResult, list):
+    # Runs fn for every item and times each call
+    # The peak memory is measured in a second run with tracemalloc, which would skew the timings.
+    # Returns the stage result and the results of the calls.
+    items = list(items)
+    results = []
+    latencies = []
+    pages = 0
+    ingredients = 0
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        result = fn(item)
+        latencies.append(time.perf_counter() - t)
+        results.append(result)
+        pages += pages_of(item)
+        ingredients += ingredients_of(result)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            for item in items:
+                fn(item)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return StageResult(name, pages, ingredients, seconds, latencies, peak), results
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float) -> List[str]:
+    # Returns the stages whose throughput dropped more than threshold (e.g. 0.1 = 10 %) below the baseline
+    regressions = []
+    for name, stage in results.items():
+        base = baseline.get(name)
+        if base is None or not base.get("pages_per_s"):
+            continue
+        if stage["pages_per_s"] < base["pages_per_s"] * (1.0 - threshold):
+            regressions.append("%s: %.1f pages/s, baseline %.1f pages/s"
+                               % (name, stage["pages_per_s"], base["pages_per_s"]))
+    return regressions
@@ -0,0 +1,2 @@
+from .progress import Progress
+from .registry import NULL_METRICS, Metrics, NullMetrics
@@ -0,0 +1,55 @@
+import sys
+import threading
+
+
+class Progress:
+    # Single status line that is redrawn from a background thread
+    # update() only stores the latest status, so calling it in a hot loop costs next to nothing.
+    # The line is written to the output at most once per interval.
+
+    def __init__(self, interval: float = 0.2, output=None):
+        self._interval = interval
+        self._output = output or sys.stdout
+        self._line = None
+        self._written = None
+        self._last_len = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self, line: str):
+        self._line = line
+
+    def _draw(self):
+        line = self._line
+        if line is None or line is self._written:
+            return
+        self._written = line
+        # Pad with spaces to clear the end of a longer previous line
+        self._output.write("\r" + line.ljust(self._last_len))
+        self._output.flush()
+        self._last_len = len(line)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._draw()
+
+    def start(self) -> "Progress":
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Show the final status and end the line
+        self._draw()
+        if self._written is not None:
+            self._output.write("\n")
+            self._output.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
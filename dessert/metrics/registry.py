@@ -0,0 +1,149 @@
+import json
+import re
+import threading
+import time
+from typing import Callable
+
+
+class _Timer:
+    # Context manager that records the elapsed time to a Metrics timer
+
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self._metrics = metrics
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+
+
+class _NullTimer:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    # Thread-safe counters and timers
+    # Counters are plain totals (requests, bytes, cache hits, ...). Timers keep the count, total and
+    # maximum of the observed durations in seconds. Hooks are called with (kind, name, value) on
+    # every update, kind being "counter" or "timer".
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._hooks = []
+
+    def add_hook(self, hook: Callable[[str, str, float], None]):
+        self._hooks.append(hook)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for hook in self._hooks:
+            hook("counter", name, value)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+        for hook in self._hooks:
+            hook("timer", name, seconds)
+
+    def timer(self, name: str) -> _Timer:
+        # with metrics.timer("parse"): ...
+        return _Timer(self, name)
+
+    def merge(self, snapshot: dict):
+        # Adds a snapshot taken elsewhere, e.g. in a worker process, to these metrics
+        # The hooks are not called for the merged values.
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for name, other in snapshot["timers"].items():
+                timer = self._timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += other["count"]
+                timer[1] += other["total_seconds"]
+                timer[2] = max(timer[2], other["max_seconds"])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "timers": {name: {"count": count, "total_seconds": total, "max_seconds": maximum}
+                           for name, (count, total, maximum) in self._timers.items()}
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix: str = "dessert_") -> str:
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = _metric_name(prefix + name + "_total")
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, _number(value)))
+        for name, timer in sorted(snapshot["timers"].items()):
+            metric = _metric_name(prefix + name + "_seconds")
+            lines.append("# TYPE %s summary" % metric)
+            lines.append("%s_count %d" % (metric, timer["count"]))
+            lines.append("%s_sum %s" % (metric, _number(timer["total_seconds"])))
+            lines.append("# TYPE %s_max gauge" % metric)
+            lines.append("%s_max %s" % (metric, _number(timer["max_seconds"])))
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics(Metrics):
+    # Disabled metrics, every call is a no-op
+    enabled = False
+
+    def add_hook(self, hook):
+        pass
+
+    def inc(self, name, value=1):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def merge(self, snapshot):
+        pass
+
+
+# Shared instance for components that are not given a Metrics
+NULL_METRICS = NullMetrics()
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
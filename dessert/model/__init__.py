@@ -1 +1,3 @@
-from .ingredient import Ingredient
+from .columnar import CorpusFile, write_corpus
+from .corpus import IngredientCorpus
+from .ingredient import Ingredient, ingredients_from_data, ingredients_to_data, map_ingredient_names
@@ -0,0 +1,220 @@
+import argparse
+import mmap
+import struct
+import sys
+from array import array
+from collections import Counter
+from itertools import compress
+from typing import Iterator, List, Tuple
+
+from .corpus import IngredientCorpus
+
+# Columnar binary file of an IngredientCorpus
+# One row per ingredient node: dessert, name, parent row and depth, like in IngredientCorpus.
+# The titles and the ingredient names are dictionary encoded into string tables.
+#
+# Layout (little-endian, every section starts at a multiple of 8 bytes):
+#   header:   magic "DCOL", version, row count, title count, name count and the offsets of
+#             the 8 sections below
+#   dessert:  uint32 per row, index of the dessert title
+#   name:     uint32 per row, index of the ingredient name
+#   parent:   int32 per row, row of the parent ingredient or -1
+#   depth:    uint8 per row
+#   title offsets, title data: uint64 start offsets (count + 1) and the UTF-8 encoded titles
+#   name offsets, name data:   the same for the ingredient names
+#
+# The file is read with CorpusFile, which memory-maps it. The columns are used as they are in
+# the file and the aggregations run over them in C, without parsing text.
+#
+# Usage:
+#   write_corpus(corpus, "desserts.dcol")
+#   with CorpusFile("desserts.dcol") as f:
+#       f.top_names(10)
+# or python -m dessert.model.columnar desserts.dcol --top 10
+
+MAGIC = b"DCOL"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sIQII8Q")
+_COLUMNS = [("dessert", "I"), ("name", "I"), ("parent", "i"), ("depth", "B")]
+# Size of the chunks the columns are written in
+_CHUNK_ROWS = 1 << 16
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % 8)
+
+
+def _string_table(strings: List[str]) -> (array, bytes):
+    data = [s.encode("utf-8") for s in strings]
+    offsets = array("Q", [0])
+    total = 0
+    for d in data:
+        total += len(d)
+        offsets.append(total)
+    return offsets, b"".join(data)
+
+
+def _to_little_endian(a: array) -> array:
+    if sys.byteorder == "big" and a.itemsize > 1:
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+
+def write_corpus(corpus: IngredientCorpus, path: str, buffer_size: int = 1 << 20):
+    # Writes the corpus to a columnar file
+    # The columns are written in chunks of rows through one large write buffer.
+    title_offsets, title_data = _string_table(corpus.titles)
+    name_offsets, name_data = _string_table(corpus.names)
+    rows = len(corpus)
+    sections = [len(getattr(corpus, column)) * array(typecode).itemsize for column, typecode in _COLUMNS]
+    sections += [len(title_offsets) * 8, len(title_data), len(name_offsets) * 8, len(name_data)]
+    offsets = []
+    position = _HEADER.size + len(_padding(_HEADER.size))
+    for size in sections:
+        offsets.append(position)
+        position += size + len(_padding(size))
+
+    with open(path, "wb", buffering=buffer_size) as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, rows, len(corpus.titles), len(corpus.names), *offsets))
+        f.write(_padding(_HEADER.size))
+        for (column, _), size in zip(_COLUMNS, sections):
+            values = getattr(corpus, column)
+            for start in range(0, rows, _CHUNK_ROWS):
+                _to_little_endian(values[start:start + _CHUNK_ROWS]).tofile(f)
+            f.write(_padding(size))
+        for table in (title_offsets, title_data, name_offsets, name_data):
+            if isinstance(table, array):
+                _to_little_endian(table).tofile(f)
+                f.write(_padding(len(table) * 8))
+            else:
+                f.write(table)
+                f.write(_padding(len(table)))
+
+
+class CorpusFile:
+    # Memory-mapped, read-only view of a file written with write_corpus()
+    # The columns dessert, name, parent and depth are memoryviews over the mapped file (or
+    # arrays on big-endian machines), the strings are decoded only when they're accessed.
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self._file.close()
+            raise ValueError("\"%s\" is not a corpus file" % path)
+        self._views = []
+        header = _HEADER.unpack_from(self._map, 0) if len(self._map) >= _HEADER.size else None
+        if header is None or header[0] != MAGIC:
+            self.close()
+            raise ValueError("\"%s\" is not a corpus file" % path)
+        if header[1] != VERSION:
+            self.close()
+            raise ValueError("Unsupported corpus file version %d" % header[1])
+        _, _, self._rows, self.dessert_count, self.name_count = header[:5]
+        offsets = header[5:]
+        for (column, typecode), offset in zip(_COLUMNS, offsets):
+            setattr(self, column, self._column(offset, self._rows, typecode))
+        self._title_offsets = self._column(offsets[4], self.dessert_count + 1, "Q")
+        self._title_data = offsets[5]
+        self._name_offsets = self._column(offsets[6], self.name_count + 1, "Q")
+        self._name_data = offsets[7]
+
+    def _column(self, offset: int, count: int, typecode: str):
+        size = count * array(typecode).itemsize
+        view = memoryview(self._map)[offset:offset + size]
+        self._views.append(view)
+        if sys.byteorder == "big" and typecode != "B":
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return values
+        view = view.cast(typecode)
+        self._views.append(view)
+        return view
+
+    def __len__(self):
+        return self._rows
+
+    def _string(self, offsets, data: int, idx: int) -> str:
+        return self._map[data + offsets[idx]:data + offsets[idx + 1]].decode("utf-8")
+
+    def title(self, dessert_id: int) -> str:
+        return self._string(self._title_offsets, self._title_data, dessert_id)
+
+    def ingredient_name(self, name_id: int) -> str:
+        return self._string(self._name_offsets, self._name_data, name_id)
+
+    @property
+    def titles(self) -> List[str]:
+        return [self.title(i) for i in range(self.dessert_count)]
+
+    @property
+    def names(self) -> List[str]:
+        return [self.ingredient_name(i) for i in range(self.name_count)]
+
+    def rows(self) -> Iterator[Tuple[str, str, str, int]]:
+        # (dessert title, ingredient name, parent ingredient name or None, depth) for every row
+        names = self.names
+        titles = self.titles
+        for row in range(self._rows):
+            parent = self.parent[row]
+            yield (titles[self.dessert[row]], names[self.name[row]],
+                   names[self.name[parent]] if parent >= 0 else None, self.depth[row])
+
+    def _depth_mask(self, max_depth: int) -> bytes:
+        # One byte per row, 1 if the row is at most max_depth deep
+        # bytes.translate maps the whole depth column at once
+        table = bytes(1 if d <= max_depth else 0 for d in range(256))
+        return bytes(self.depth).translate(table)
+
+    def name_id_counts(self, max_depth: int = None) -> Counter:
+        # Number of rows per name ID, counted directly from the mapped name column
+        if max_depth is None:
+            return Counter(self.name)
+        return Counter(compress(self.name, self._depth_mask(max_depth)))
+
+    def name_counts(self, max_depth: int = None) -> Counter:
+        # Number of rows per ingredient name, same as IngredientCorpus.name_counts()
+        return Counter({self.ingredient_name(name_id): count
+                        for name_id, count in self.name_id_counts(max_depth).items()})
+
+    def top_names(self, n: int = 10, max_depth: int = None) -> List[Tuple[str, int]]:
+        # The n most common ingredient names
+        return [(self.ingredient_name(name_id), count)
+                for name_id, count in self.name_id_counts(max_depth).most_common(n)]
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m dessert.model.columnar",
+                                     description="Show the most common ingredients of a corpus file")
+    parser.add_argument("path", help="file written with main.py --export")
+    parser.add_argument("--top", type=int, default=20, help="number of ingredients to show")
+    parser.add_argument("--max-depth", type=int, help="count only the ingredients down to this depth (0 = top level)")
+    args = parser.parse_args()
+
+    with CorpusFile(args.path) as f:
+        print("%d desserts, %d rows, %d distinct ingredients" % (f.dessert_count, len(f), f.name_count))
+        for name, count in f.top_names(args.top, args.max_depth):
+            print("%8d  %s" % (count, name))
+
+
+if __name__ == "__main__":
+    main()
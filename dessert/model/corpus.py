@@ -0,0 +1,71 @@
+import sys
+from array import array
+from collections import Counter
+from typing import Iterator, Tuple
+
+from .ingredient import Ingredient
+
+
+class IngredientCorpus:
+    # Flat, array-backed view of the ingredient trees of many desserts
+    # Every ingredient node is one row. The columns are stored in typed arrays:
+    #   dessert: index of the dessert in titles
+    #   name:    index of the ingredient name in names (dictionary encoded)
+    #   parent:  row of the parent ingredient, -1 for top level ingredients
+    #   depth:   0 for top level ingredients, 1 for their sub-ingredients, etc.
+    # The rows of a dessert are contiguous and in depth-first order.
+
+    def __init__(self):
+        self.titles = []
+        self.names = []
+        self._name_ids = {}
+        self.dessert = array("I")
+        self.name = array("I")
+        self.parent = array("i")
+        self.depth = array("B")
+
+    def __len__(self):
+        return len(self.name)
+
+    def name_id(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            name = sys.intern(name)
+            self._name_ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def _add_rows(self, ingredients: [Ingredient], dessert_id: int, parent: int, depth: int):
+        for ingredient in ingredients:
+            row = len(self.name)
+            self.dessert.append(dessert_id)
+            self.name.append(self.name_id(ingredient.name))
+            self.parent.append(parent)
+            # Depth is stored in a byte
+            self.depth.append(min(depth, 255))
+            self._add_rows(ingredient.ingredients, dessert_id, row, depth + 1)
+
+    def add(self, title: str, ingredients: [Ingredient]) -> int:
+        # Adds a dessert and returns its index
+        dessert_id = len(self.titles)
+        self.titles.append(title)
+        self._add_rows(ingredients, dessert_id, -1, 0)
+        return dessert_id
+
+    def rows(self) -> Iterator[Tuple[str, str, str, int]]:
+        # (dessert title, ingredient name, parent ingredient name or None, depth) for every row
+        for row in range(len(self.name)):
+            parent = self.parent[row]
+            yield (self.titles[self.dessert[row]],
+                   self.names[self.name[row]],
+                   self.names[self.name[parent]] if parent >= 0 else None,
+                   self.depth[row])
+
+    def name_counts(self, max_depth: int = None) -> Counter:
+        # Number of rows per ingredient name, optionally only down to max_depth
+        if max_depth is None:
+            counts = Counter(self.name)
+        else:
+            counts = Counter(n for n, d in zip(self.name, self.depth) if d <= max_depth)
+        return Counter({self.names[name_id]: count for name_id, count in counts.items()})
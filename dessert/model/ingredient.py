@@ -1,8 +1,47 @@
+import sys
+from typing import Callable, Iterable
+
+
 class Ingredient:
+    # Immutable ingredient tree node
+    # The names are interned and the sub-ingredients are stored as a tuple, so the nodes are
+    # small and hashable, and unchanged subtrees can be shared between trees (see map_names()).
+    __slots__ = ("name", "ingredients", "_hash")
+
+    def __init__(self, name: str, ingredients: Iterable["Ingredient"] = ()):
+        object.__setattr__(self, "name", sys.intern(name))
+        object.__setattr__(self, "ingredients", tuple(ingredients))
+        object.__setattr__(self, "_hash", None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Ingredient is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("Ingredient is immutable")
+
+    def __reduce__(self):
+        return Ingredient, (self.name, self.ingredients)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Ingredient):
+            return NotImplemented
+        return self.name == other.name and self.ingredients == other.ingredients
 
-    def __init__(self, name, ingredients=[]):
-        self.name = name
-        self.ingredients = ingredients
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash((self.name, self.ingredients)))
+        return self._hash
+
+    def map_names(self, fn: Callable[[str], str]) -> "Ingredient":
+        # Returns a tree with fn applied to every name
+        # Nodes whose subtree doesn't change are reused as is.
+        name = fn(self.name)
+        ingredients = map_ingredient_names(self.ingredients, fn)
+        if name == self.name and ingredients is self.ingredients:
+            return self
+        return Ingredient(name, ingredients)
 
     def __str__(self):
         if len(self.ingredients) == 0:
@@ -14,3 +53,24 @@ class Ingredient:
             return "<Ingredient \"%s\", contains [%s]>" % (self.name, ", ".join([repr(i) for i in self.ingredients]))
         else:
             return "<Ingredient \"%s\">" % self.name
+
+
+def map_ingredient_names(ingredients: (Ingredient, ...), fn: Callable[[str], str]) -> (Ingredient, ...):
+    # Applies fn to every name in the ingredient trees
+    # The same tuple is returned if nothing changed.
+    mapped = tuple(i.map_names(fn) for i in ingredients)
+    if all(new is old for new, old in zip(mapped, ingredients)):
+        return ingredients
+    return mapped
+
+
+def ingredients_to_data(ingredients: [Ingredient]) -> list:
+    # Compact JSON-compatible form of the ingredient trees
+    # A leaf is just its name, other nodes are [name, [sub-ingredients]].
+    return [i.name if len(i.ingredients) == 0 else [i.name, ingredients_to_data(i.ingredients)]
+            for i in ingredients]
+
+
+def ingredients_from_data(data: list) -> [Ingredient]:
+    return [Ingredient(d) if isinstance(d, str) else Ingredient(d[0], ingredients_from_data(d[1]))
+            for d in data]
@@ -1 +1,3 @@
+from .memo import LRUMemo
 from .processor import IngredientProcessor
+from .resources import missing_resources, prefetch_resources
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Callable
+
+
+class LRUMemo:
+    # Size-bounded memo of string -> string results with hit/miss counters
+    # The least recently used entries are dropped when the memo is full.
+    # to_dict() and update() can be used to keep the memo between runs.
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str, compute: Callable[[str], str]) -> str:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            if self.maxsize > 0:
+                self._entries[key] = value
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            return value
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def to_dict(self) -> dict:
+        return dict(self._entries)
+
+    def update(self, entries: dict):
+        # Add entries (e.g. loaded from a file) without counting them as hits or misses
+        for key, value in entries.items():
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
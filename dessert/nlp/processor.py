@@ -1,41 +1,105 @@
+import json
 import re
 
 import nltk
 from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
 from nltk.tokenize import word_tokenize
 
 from dessert.model import Ingredient
 
+from .memo import LRUMemo
+from .resources import require
+
 
 class IngredientProcessor:
+    # Bump when the normalization results change, this invalidates the cached results
+    VERSION = 1
 
-    def __init__(self):
-        # Initialize NLTK resources
-        nltk.download("stopwords")
-        nltk.download("punkt")
-        nltk.download("wordnet")
-        # Extend NLTK stopwords
-        self._stopwords = stopwords.words("english")
-        self._stopwords.extend([
-            ".", "etc.", "etc", "sometimes"
-        ])
+    def __init__(self, cache_size: int = 10000):
+        # NLTK resources are loaded lazily on first use and never downloaded here,
+        # see dessert.nlp.resources.prefetch_resources()
+        self._stopwords = None
+        self._lemmatizer = None
+        self._tokenizer_checked = False
+        # The same ingredient names appear in hundreds of desserts, so the normalized names
+        # and lemmas are memoized
+        self.normalize_memo = LRUMemo(cache_size)
+        self.lemma_memo = LRUMemo(cache_size)
 
-    def _normalize(self, ingredient_name: str) -> str:
+    @property
+    def version(self) -> str:
+        # The tokenizer and the stop words come from NLTK, so its version matters too
+        return "%d+nltk%s" % (IngredientProcessor.VERSION, nltk.__version__)
+
+    @property
+    def stopwords(self) -> frozenset:
+        if self._stopwords is None:
+            require("stopwords")
+            # Extend NLTK stopwords
+            # A set, as every token is checked against these
+            self._stopwords = frozenset(stopwords.words("english") + [
+                ".", "etc.", "etc", "sometimes"
+            ])
+        return self._stopwords
+
+    def _normalize_uncached(self, ingredient_name: str) -> str:
         # TODO: Use a stemmer and/or dictionary
         # If the name begins with something that ends with ":", remove everything before the ":"
         # This removes cases like "Filling: something" and "Crust: something", etc.
         ingredient_name = re.sub(r"^.*?:", "", ingredient_name)
         # Tokenize
+        if not self._tokenizer_checked:
+            require("punkt")
+            self._tokenizer_checked = True
         tokens = word_tokenize(ingredient_name)
         # Remove stop words
-        filtered = [w for w in tokens if not w in self._stopwords]
+        stop = self.stopwords
+        filtered = [w for w in tokens if not w in stop]
 
         filtered_name = " ".join(filtered)
         return filtered_name
 
+    def _normalize(self, ingredient_name: str) -> str:
+        return self.normalize_memo.get(ingredient_name, self._normalize_uncached)
+
+    def _lemmatize_uncached(self, name: str) -> str:
+        if self._lemmatizer is None:
+            require("wordnet")
+            self._lemmatizer = WordNetLemmatizer()
+        return self._lemmatizer.lemmatize(name.lower())
+
+    def lemmatize(self, name: str) -> str:
+        # Lowercased WordNet lemma of the name
+        return self.lemma_memo.get(name, self._lemmatize_uncached)
+
     def normalize_ingredients(self, ingredients: [Ingredient]) -> [Ingredient]:
-        normalized = []
-        for ingredient in ingredients:
-            normalized.append(Ingredient(self._normalize(
-                ingredient.name), self.normalize_ingredients(ingredient.ingredients)))
-        return normalized
+        # Only the nodes whose names change are copied
+        return [ingredient.map_names(self._normalize) for ingredient in ingredients]
+
+    def memo_stats(self) -> dict:
+        return {
+            "normalize": self.normalize_memo.stats(),
+            "lemmatize": self.lemma_memo.stats()
+        }
+
+    def save_memo(self, path: str):
+        # Save both memos to a single JSON file
+        # The file is stamped with the processor version, see load_memo()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": self.version,
+                "normalize": self.normalize_memo.to_dict(),
+                "lemmatize": self.lemma_memo.to_dict()
+            }, f, ensure_ascii=False)
+
+    def load_memo(self, path: str) -> bool:
+        # Returns False and leaves the memos as they are if the file was saved by another
+        # processor or NLTK version, as its names could differ from what this version gives
+        with open(path, "r", encoding="utf-8") as f:
+            memos = json.load(f)
+        if memos.get("version") != self.version:
+            return False
+        self.normalize_memo.update(memos.get("normalize", {}))
+        self.lemma_memo.update(memos.get("lemmatize", {}))
+        return True
@@ -0,0 +1,56 @@
+import nltk
+from nltk.tokenize import punkt
+
+# word_tokenize() loads "punkt_tab" in the NLTK versions that have PunktTokenizer (3.8.2 and
+# later) and the pickled "punkt" models in the older ones, only that one counts as installed
+if hasattr(punkt, "PunktTokenizer"):
+    _PUNKT_PATH, _PUNKT_PACKAGE = "tokenizers/punkt_tab/english/", "punkt_tab"
+else:
+    _PUNKT_PATH, _PUNKT_PACKAGE = "tokenizers/punkt/english.pickle", "punkt"
+
+# NLTK resources used by the ingredient processor and their paths in the NLTK data directories
+RESOURCES = {
+    "stopwords": ["corpora/stopwords"],
+    "punkt": [_PUNKT_PATH],
+    "wordnet": ["corpora/wordnet"],
+}
+
+# Packages to download for each resource
+_PACKAGES = {
+    "stopwords": ["stopwords"],
+    "punkt": [_PUNKT_PACKAGE],
+    "wordnet": ["wordnet"],
+}
+
+
+def _find(path: str) -> bool:
+    # Look up a resource from the local NLTK data directories only, this never touches the network
+    # nltk.data.find() also finds resources that are installed as zip files.
+    try:
+        nltk.data.find(path)
+        return True
+    except LookupError:
+        return False
+
+
+def is_available(name: str) -> bool:
+    return any(_find(path) for path in RESOURCES[name])
+
+
+def missing_resources() -> [str]:
+    return [name for name in RESOURCES if not is_available(name)]
+
+
+def require(name: str):
+    # Raises LookupError with provisioning instructions if the resource is not installed
+    if not is_available(name):
+        raise LookupError("NLTK resource \"%s\" is not installed. Run \"python main.py --prefetch\" "
+                          "on a machine with network access or install it with nltk.download()." % name)
+
+
+def prefetch_resources(quiet: bool = False) -> bool:
+    # Download the missing resources, returns True if all resources are available afterwards
+    for name in missing_resources():
+        for package in _PACKAGES[name]:
+            nltk.download(package, quiet=quiet)
+    return len(missing_resources()) == 0
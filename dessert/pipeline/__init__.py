@@ -0,0 +1,2 @@
+from .pipeline import DessertPipeline
+from .results import ResultCache, content_key
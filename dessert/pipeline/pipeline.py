@@ -0,0 +1,217 @@
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from dessert.metrics import NULL_METRICS, Metrics
+from dessert.model import Ingredient
+from dessert.nlp import IngredientProcessor
+from dessert.wiki import WikiPage, WikiParser, WikiSource
+
+from .results import ResultCache, content_key
+
+# Marks the end of the fetched batches in the queue
+_DONE = object()
+
+# Parser, processor and metrics switch of a worker process, set by _init_worker()
+_worker_parser = None
+_worker_processor = None
+_worker_metrics = False
+
+
+def _init_worker(parser: WikiParser, processor: IngredientProcessor, metrics: bool):
+    # Runs once in each worker process
+    # The parser and processor are pickled copies of the ones in the main process, so the NLTK
+    # resources are already initialized and don't have to be downloaded again.
+    global _worker_parser, _worker_processor, _worker_metrics
+    _worker_parser = parser
+    _worker_processor = processor
+    _worker_metrics = metrics
+
+
+def _process_pages(pages: [(str, WikiPage)]) -> ([(str, Optional[List[Ingredient]])], dict):
+    # Returns the results and a snapshot of the chunk's metrics (None if metrics are disabled)
+    # for the main process to merge
+    # The ingredients of the pages that failed are None, see _process_page()
+    metrics = Metrics() if _worker_metrics else NULL_METRICS
+    results = [(title, _process_page(_worker_parser, _worker_processor, page, metrics)) for title, page in pages]
+    return results, metrics.snapshot() if metrics.enabled else None
+
+
+def _process_page(parser: WikiParser, processor: IngredientProcessor, page: WikiPage,
+                  metrics: Metrics = NULL_METRICS) -> Optional[List[Ingredient]]:
+    # A page that fails is logged and None is returned, the rest of the batch goes on
+    # The failed pages are not stored to the result cache, so they're tried again on the next run.
+    # LookupError means that NLTK resources are missing, which fails every page, so it's raised.
+    try:
+        with metrics.timer("parse"):
+            ingredients = parser.get_dessert_ingredients(page)
+        if len(ingredients) > 0:
+            # Try to process ingredients (normalize names)
+            with metrics.timer("normalize"):
+                ingredients = processor.normalize_ingredients(ingredients)
+    except LookupError:
+        raise
+    except Exception as e:
+        print("Failed to parse \"%s\": %r" % (page.title, e), file=sys.stderr)
+        metrics.inc("parse_errors")
+        return None
+    return ingredients
+
+
+class _FetchError:
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class DessertPipeline:
+    # Streaming fetch -> parse -> normalize pipeline
+    # The pages are fetched in a background thread and handed over batch by batch through a
+    # bounded queue, so parsing starts as soon as the first batch arrives and at most
+    # buffer_size batches are held in memory at any time.
+    # With workers > 0 the parsing and normalization is sharded over a process pool in chunks of
+    # chunk_size pages. The results are yielded in the same order in both modes.
+    # If a result cache is given, pages whose wikitext was already processed by the same parser
+    # and normalizer versions are loaded from it batch by batch instead of parsing them again.
+    # metrics collects the per page parse and normalize times and the result cache counters.
+
+    def __init__(self, source: WikiSource, parser: WikiParser, processor: IngredientProcessor,
+                 buffer_size: int = 4, workers: int = 0, chunk_size: int = 10,
+                 result_cache: ResultCache = None, metrics: Metrics = None):
+        self._source = source
+        self._parser = parser
+        self._processor = processor
+        self._buffer_size = buffer_size
+        self._workers = workers
+        self._chunk_size = chunk_size
+        self._result_cache = result_cache
+        self._metrics = metrics or NULL_METRICS
+
+    @staticmethod
+    def results_version(parser: WikiParser, processor: IngredientProcessor) -> str:
+        # Version of the results for ResultCache
+        return "parser-%s/processor-%s" % (parser.version, processor.version)
+
+    def _split_cached(self, batch: [(str, WikiPage)]):
+        # Yields (title, page, key, cached ingredients or None) for the batch
+        if self._result_cache is None:
+            for title, page in batch:
+                yield title, page, None, None
+            return
+        keys = [content_key(page.raw) for _, page in batch]
+        cached = self._result_cache.get_many(keys)
+        self._metrics.inc("result_cache_hits", len(cached))
+        self._metrics.inc("result_cache_misses", len(keys) - len(cached))
+        for (title, page), key in zip(batch, keys):
+            yield title, page, key, cached.get(key)
+
+    def _store(self, results: [(str, [Ingredient])]):
+        if self._result_cache is not None and len(results) > 0:
+            self._result_cache.put_many(results)
+
+    def _iter_fetched(self, page_titles: Iterable[str]):
+        batches = queue.Queue(maxsize=self._buffer_size)
+        stop = threading.Event()
+
+        def put(item):
+            # Block while the buffer is full, but give up if the consumer went away
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self._source.iter_dessert_wikitexts(page_titles):
+                    if not put(batch):
+                        return
+                put(_DONE)
+            except BaseException as e:
+                put(_FetchError(e))
+
+        fetcher = threading.Thread(target=fetch, name="dessert-fetch", daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _DONE:
+                    break
+                if isinstance(batch, _FetchError):
+                    raise batch.error
+                yield batch
+        finally:
+            stop.set()
+            fetcher.join()
+
+    def _run_parallel(self, page_titles: Iterable[str]) -> Iterator[Tuple[str, List[Ingredient]]]:
+        with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_worker,
+                                 initargs=(self._parser, self._processor, self._metrics.enabled)) as executor:
+            # Keep every worker busy but bound the number of chunks waiting for the consumer
+            # The queue holds (future, result keys) for the parsed chunks and (None, results) for
+            # the cached results, in order.
+            pending = deque()
+
+            def pop():
+                future, value = pending.popleft()
+                if future is None:
+                    return value
+                results, snapshot = future.result()
+                if snapshot is not None:
+                    self._metrics.merge(snapshot)
+                if value is not None:
+                    self._store([(key, ingredients) for key, (_, ingredients) in zip(value, results)
+                                 if ingredients is not None])
+                return [(title, ingredients or []) for title, ingredients in results]
+
+            def submit(chunk):
+                future = executor.submit(_process_pages, [(title, page) for title, page, _, _ in chunk])
+                keys = None if self._result_cache is None else [key for _, _, key, _ in chunk]
+                pending.append((future, keys))
+
+            for batch in self._iter_fetched(page_titles):
+                chunk = []
+                for title, page, key, cached in self._split_cached(batch):
+                    if cached is not None:
+                        if len(chunk) > 0:
+                            submit(chunk)
+                            chunk = []
+                        pending.append((None, [(title, cached)]))
+                    else:
+                        chunk.append((title, page, key, cached))
+                        if len(chunk) >= self._chunk_size:
+                            submit(chunk)
+                            chunk = []
+                if len(chunk) > 0:
+                    submit(chunk)
+                while len(pending) >= self._workers * 2:
+                    yield from pop()
+            while len(pending) > 0:
+                yield from pop()
+
+    def run(self, page_titles: Iterable[str]) -> Iterator[Tuple[str, List[Ingredient]]]:
+        # Yields (title, normalized ingredients) for every fetched page as soon as it's processed
+        # Pages without ingredients are yielded with an empty list.
+        if self._workers > 0:
+            yield from self._run_parallel(page_titles)
+            return
+        for batch in self._iter_fetched(page_titles):
+            new_results = []
+            for title, page, key, cached in self._split_cached(batch):
+                if cached is not None:
+                    yield title, cached
+                    continue
+                ingredients = _process_page(self._parser, self._processor, page, self._metrics)
+                if ingredients is None:
+                    # Failed, not cached
+                    yield title, []
+                    continue
+                if key is not None:
+                    new_results.append((key, ingredients))
+                yield title, ingredients
+            self._store(new_results)
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+
+from dessert.model import Ingredient, ingredients_from_data, ingredients_to_data
+
+
+def content_key(wikitext: str) -> str:
+    # Results are keyed by the hash of the page wikitext
+    return hashlib.sha1(wikitext.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    # SQLite cache of the parsed and normalized ingredients of each page
+    # The entries are keyed by the hash of the wikitext and the version of the code that produced
+    # them. A changed page gets a new key, and entries made by other parser/normalizer versions
+    # are removed when the cache is opened.
+
+    def __init__(self, version: str, path: str = "results.db"):
+        self.version = version
+        # The connection is shared between threads, access is serialized with a lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT NOT NULL, version TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (key, version))")
+            self._db.execute("DELETE FROM results WHERE version != ?", (version,))
+
+    def get_many(self, keys: [str]) -> {str: [Ingredient]}:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, data FROM results WHERE version = ? AND key IN (SELECT value FROM json_each(?))",
+                (self.version, json.dumps(list(keys)))).fetchall()
+        return {key: ingredients_from_data(json.loads(zlib.decompress(data))) for key, data in rows}
+
+    def put_many(self, results: [(str, [Ingredient])]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (key, version, data) VALUES (?, ?, ?)",
+                [(key, self.version, zlib.compress(json.dumps(ingredients_to_data(ingredients)).encode("utf-8")))
+                 for key, ingredients in results])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
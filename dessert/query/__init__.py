@@ -0,0 +1,5 @@
+from .index import IngredientIndex, bigrams, jaccard
+# BigramSimilarity and batch_similarity are imported from dessert.query.similarity directly,
+# so that numpy and scipy are loaded only when they are used
+from .service import QueryService
+from .cooccurrence import IngredientStats
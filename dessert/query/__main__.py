@@ -0,0 +1,42 @@
+import argparse
+
+from dessert.model import CorpusFile
+
+from .cooccurrence import IngredientStats
+
+# Ingredient statistics of a corpus file written with main.py --export
+# Usage:
+#   python -m dessert.query desserts.dcol                     most common ingredients
+#   python -m dessert.query desserts.dcol --with milk almond  desserts with all the ingredients
+#   python -m dessert.query desserts.dcol --cooccurring milk  ingredients used together with milk
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m dessert.query",
+                                     description="Ingredient statistics of a corpus file")
+    parser.add_argument("path", help="file written with main.py --export")
+    parser.add_argument("--with", dest="names", nargs="+", metavar="INGREDIENT",
+                        help="list the desserts that use all these ingredients")
+    parser.add_argument("--cooccurring", metavar="INGREDIENT",
+                        help="show the ingredients used together with this ingredient")
+    parser.add_argument("--top", type=int, default=20, help="number of ingredients to show")
+    parser.add_argument("--max-depth", type=int, default=1,
+                        help="count the ingredients down to this depth (0 = top level, default: 1)")
+    args = parser.parse_args()
+
+    with CorpusFile(args.path) as f:
+        stats = IngredientStats.from_corpus(f, max_depth=args.max_depth)
+    print("%d desserts, %d distinct ingredients" % (len(stats), len(stats.names)))
+    if args.names:
+        for title in stats.desserts_with(args.names):
+            print(title)
+    elif args.cooccurring:
+        for name, count in stats.cooccurring(args.cooccurring, args.top):
+            print("%8d  %s" % (count, name))
+    else:
+        for name, count in stats.top(args.top):
+            print("%8d  %s" % (count, name))
+
+
+if __name__ == "__main__":
+    main()
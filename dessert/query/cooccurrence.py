@@ -0,0 +1,152 @@
+from collections import Counter
+from itertools import combinations
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from dessert.model import Ingredient
+
+# Reverse ingredient index and co-occurrence counts of a dessert corpus
+# Every distinct ingredient name has a bitset of the desserts that use it, stored as a Python
+# int where bit i is dessert i. "Which desserts use X and Y" is then one AND of two ints and the
+# number of them is a popcount, without going through the ingredient trees again.
+# The co-occurrence counts (number of desserts that use both X and Y) are updated as the
+# desserts are added, so the most common companions of an ingredient are a lookup.
+# Unlike IngredientIndex, the names are matched exactly (after the key function), so the
+# ingredients should be normalized first.
+#
+# Usage:
+#   stats = IngredientStats()
+#   stats.add_all(pipeline.run(titles))
+#   stats.desserts_with(["milk", "almond"])
+#   stats.cooccurring("milk", 10)
+#   stats.top(10)
+# or python -m dessert.query desserts.dcol --with milk almond
+
+
+def _bit_indices(bits: int) -> List[int]:
+    # Indices of the set bits, lowest first
+    # The binary string is reversed once and searched, which is linear in the number of bits
+    digits = bin(bits)[:1:-1]
+    indices = []
+    idx = digits.find("1")
+    while idx >= 0:
+        indices.append(idx)
+        idx = digits.find("1", idx + 1)
+    return indices
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+class IngredientStats:
+
+    def __init__(self, key: Optional[Callable[[str], str]] = None, max_depth: int = 1):
+        # key maps an ingredient name to the counted form, the ingredients are counted on the top
+        # level and on their sub-ingredients down to max_depth like in IngredientIndex
+        self._key = key or str.lower
+        self._max_depth = max_depth
+        self.titles = []
+        self.names = []
+        self._name_ids = {}
+        # Name ID -> bitset of the desserts that use the name
+        self._desserts = []
+        # Name ID -> Counter of the other name IDs in the same desserts
+        self._pairs = []
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _name_id(self, name: str) -> int:
+        key = self._key(name)
+        name_id = self._name_ids.get(key)
+        if name_id is None:
+            name_id = len(self.names)
+            self._name_ids[key] = name_id
+            self.names.append(key)
+            self._desserts.append(0)
+            self._pairs.append(Counter())
+        return name_id
+
+    def _collect_names(self, ingredients: [Ingredient], name_ids: set, depth: int):
+        for ingredient in ingredients:
+            name_ids.add(self._name_id(ingredient.name))
+            if depth < self._max_depth:
+                self._collect_names(ingredient.ingredients, name_ids, depth + 1)
+
+    def _add_name_ids(self, title: str, name_ids: set) -> int:
+        dessert_id = len(self.titles)
+        self.titles.append(title)
+        bit = 1 << dessert_id
+        for name_id in name_ids:
+            self._desserts[name_id] |= bit
+        for a, b in combinations(sorted(name_ids), 2):
+            self._pairs[a][b] += 1
+            self._pairs[b][a] += 1
+        return dessert_id
+
+    def add(self, title: str, ingredients: [Ingredient]) -> int:
+        # Adds a dessert and returns its index
+        name_ids = set()
+        self._collect_names(ingredients, name_ids, 0)
+        return self._add_name_ids(title, name_ids)
+
+    def add_all(self, desserts: Iterable[Tuple[str, List[Ingredient]]]):
+        for title, ingredients in desserts:
+            self.add(title, ingredients)
+
+    @classmethod
+    def from_corpus(cls, corpus, key: Optional[Callable[[str], str]] = None,
+                    max_depth: int = 1) -> "IngredientStats":
+        # Builds the stats from the columns of an IngredientCorpus or a CorpusFile
+        # The rows of a dessert are contiguous, so the desserts are added in one pass.
+        stats = cls(key, max_depth)
+        names = corpus.names
+        titles = corpus.titles
+        rows = iter(zip(corpus.dessert, corpus.name, corpus.depth))
+        row = next(rows, None)
+        for dessert_id, title in enumerate(titles):
+            name_ids = set()
+            while row is not None and row[0] == dessert_id:
+                if row[2] <= max_depth:
+                    name_ids.add(stats._name_id(names[row[1]]))
+                row = next(rows, None)
+            stats._add_name_ids(title, name_ids)
+        return stats
+
+    def _bits(self, name: str) -> int:
+        name_id = self._name_ids.get(self._key(name))
+        return 0 if name_id is None else self._desserts[name_id]
+
+    def _matching_bits(self, names: [str], exclude: [str] = ()) -> int:
+        # All the desserts if names is empty
+        bits = (1 << len(self.titles)) - 1
+        for name in names:
+            bits &= self._bits(name)
+            if bits == 0:
+                return 0
+        for name in exclude:
+            bits &= ~self._bits(name)
+        return bits
+
+    def desserts_with(self, names: [str], exclude: [str] = ()) -> [str]:
+        # Titles of the desserts that use all the names and none of the excluded ones, in the
+        # order they were added
+        return [self.titles[i] for i in _bit_indices(self._matching_bits(names, exclude))]
+
+    def count(self, names: [str], exclude: [str] = ()) -> int:
+        # Number of the desserts that desserts_with() would return
+        return _popcount(self._matching_bits(names, exclude))
+
+    def cooccurring(self, name: str, n: int = None) -> [(str, int)]:
+        # The names that are used together with the name, most common first, with the number of
+        # desserts that use both
+        name_id = self._name_ids.get(self._key(name))
+        if name_id is None:
+            return []
+        return [(self.names[other], count) for other, count in self._pairs[name_id].most_common(n)]
+
+    def top(self, n: int = None) -> [(str, int)]:
+        # The names used by the most desserts, with the number of desserts
+        counts = Counter({name: _popcount(bits) for name, bits in zip(self.names, self._desserts)})
+        return counts.most_common(n)
+
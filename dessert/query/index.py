@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+from math import floor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from dessert.model import Ingredient
+
+
+def bigrams(word: str) -> frozenset:
+    # Character bigrams of the word, same as "".join() over nltk.ngrams(word, 2)
+    return frozenset(word[i:i+2] for i in range(len(word) - 1))
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    # Jaccard similarity of two bigram sets (0.0 if both are empty)
+    union = len(a | b)
+    if union == 0:
+        return 0.0
+    return len(a & b) / union
+
+
+class IngredientIndex:
+    # Inverted bigram index over the ingredient names of a dessert corpus
+    # Answers "desserts that contain all of these ingredients" queries. An ingredient matches a
+    # query term if the Jaccard similarity of their bigrams is above the threshold, which is the
+    # same rule as sim() in main.py. The ingredients are matched on the top level and on their
+    # sub-ingredients down to max_depth.
+    #
+    # Candidate names for a term are found with prefix filtering: a name can be above the threshold
+    # only if it shares one of the rarest (|term| - minimum overlap + 1) bigrams of the term. The
+    # candidates are then pruned by size before computing the exact similarity.
+
+    def __init__(self, key: Optional[Callable[[str], str]] = None, max_depth: int = 1, memo_size: int = 1024):
+        # key maps an ingredient name to the indexed form (e.g. lowercased and lemmatized)
+        # memo_size: number of (term, threshold) matches to remember, the least recently used are
+        #   dropped so that e.g. a long-running QueryService doesn't grow with every new term
+        self._key = key or str.lower
+        self._max_depth = max_depth
+        self._desserts: List[Tuple[str, List[Ingredient]]] = []
+        # Indexed name -> name ID
+        self._name_ids = {}
+        # Name ID -> bigrams of the name
+        self._name_bigrams: List[frozenset] = []
+        # Name ID -> IDs of the desserts that contain the name
+        self._postings: List[set] = []
+        # Bigram -> IDs of the names that contain the bigram
+        self._bigram_names = {}
+        # Memoized term matches, cleared when new names are added
+        # The lock is needed as the QueryService handler threads share the index.
+        self._term_names = OrderedDict()
+        self._memo_size = memo_size
+        self._memo_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._desserts)
+
+    def _add_name(self, name: str, dessert_id: int):
+        key = self._key(name)
+        name_id = self._name_ids.get(key)
+        if name_id is None:
+            name_id = len(self._name_bigrams)
+            self._name_ids[key] = name_id
+            grams = bigrams(key)
+            self._name_bigrams.append(grams)
+            self._postings.append(set())
+            for gram in grams:
+                self._bigram_names.setdefault(gram, set()).add(name_id)
+            with self._memo_lock:
+                self._term_names.clear()
+        self._postings[name_id].add(dessert_id)
+
+    def _add_names(self, ingredients: [Ingredient], dessert_id: int, depth: int):
+        for ingredient in ingredients:
+            self._add_name(ingredient.name, dessert_id)
+            if depth < self._max_depth:
+                self._add_names(ingredient.ingredients, dessert_id, depth + 1)
+
+    def add(self, title: str, ingredients: [Ingredient]):
+        dessert_id = len(self._desserts)
+        self._desserts.append((title, ingredients))
+        self._add_names(ingredients, dessert_id, 0)
+
+    def add_all(self, desserts: Iterable[Tuple[str, List[Ingredient]]]):
+        for title, ingredients in desserts:
+            self.add(title, ingredients)
+
+    def _similar_names(self, term: str, threshold: float) -> [int]:
+        memo_key = (term, threshold)
+        with self._memo_lock:
+            matches = self._term_names.get(memo_key)
+            if matches is not None:
+                self._term_names.move_to_end(memo_key)
+                return matches
+
+        term_grams = bigrams(term)
+        size = len(term_grams)
+        matches = []
+        if size > 0:
+            # Every match must share more than threshold * |term| bigrams with the term
+            min_overlap = floor(threshold * size) + 1
+            if min_overlap <= size:
+                # Rarest bigrams first, so that the prefix has the shortest posting lists
+                ordered = sorted(term_grams, key=lambda g: len(self._bigram_names.get(g, ())))
+                candidates = set()
+                for gram in ordered[:size - min_overlap + 1]:
+                    candidates.update(self._bigram_names.get(gram, ()))
+                for name_id in candidates:
+                    name_grams = self._name_bigrams[name_id]
+                    # Size filter: threshold * |term| < |name| < |term| / threshold
+                    name_size = len(name_grams)
+                    if name_size <= threshold * size or (threshold > 0 and name_size >= size / threshold):
+                        continue
+                    if jaccard(name_grams, term_grams) > threshold:
+                        matches.append(name_id)
+
+        with self._memo_lock:
+            if self._memo_size > 0:
+                self._term_names[memo_key] = matches
+                if len(self._term_names) > self._memo_size:
+                    self._term_names.popitem(last=False)
+        return matches
+
+    def matching_ids(self, term: str, threshold: float = 0.5) -> set:
+        # IDs of the desserts that have an ingredient matching the term
+        dessert_ids = set()
+        for name_id in self._similar_names(term.lower(), threshold):
+            dessert_ids.update(self._postings[name_id])
+        return dessert_ids
+
+    def query(self, terms: [str], threshold: float = 0.5, exclude: [str] = ()) -> [(str, [Ingredient])]:
+        # Desserts that contain all the terms and none of the excluded terms, in the order they
+        # were added
+        if len(terms) == 0:
+            if len(exclude) == 0:
+                return self._desserts[:]
+            dessert_ids = range(len(self._desserts))
+        else:
+            # Start from the term with the fewest matches to keep the intersections small
+            matches = sorted((self.matching_ids(term, threshold) for term in terms), key=len)
+            dessert_ids = matches[0]
+            for ids in matches[1:]:
+                dessert_ids = dessert_ids & ids
+                if len(dessert_ids) == 0:
+                    break
+            dessert_ids = sorted(dessert_ids)
+        excluded = set()
+        for term in exclude:
+            excluded.update(self.matching_ids(term, threshold))
+        return [self._desserts[i] for i in dessert_ids if i not in excluded]
@@ -0,0 +1,180 @@
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from dessert.model import ingredients_to_data
+
+from .index import IngredientIndex
+
+# Resident HTTP query service over an IngredientIndex
+# The index is built once with the loader and then answers queries from memory. The watched
+# files (e.g. the wikitext and result caches) are polled in the background, and when one of them
+# changes the index is rebuilt with the loader and swapped in atomically. The queries keep using
+# the old index until the new one is ready.
+#
+# Endpoints (GET, JSON responses):
+#   /query?include=milk,almond&exclude=egg&threshold=0.5
+#       Desserts with all the included ingredients and none of the excluded ones.
+#       include and exclude can also be repeated: include=milk&include=almond
+#   /status
+#       Number of desserts, when the index was loaded and how many times it was reloaded
+#
+# Usage:
+#   with QueryService(loader, watch=["wikitext.db"], port=8081) as service:
+#       ...
+# or service.serve_forever()
+
+
+def _terms(values: [str]) -> [str]:
+    return [term.strip() for value in values for term in value.split(",") if term.strip()]
+
+
+class QueryService:
+
+    def __init__(self, loader: Callable[[], IngredientIndex], watch: Iterable[str] = (),
+                 host: str = "127.0.0.1", port: int = 0, interval: float = 5.0, index: IngredientIndex = None):
+        # loader builds a new index on every reload, and the first one too if index is not given
+        # interval: seconds between the checks of the watched files
+        self._loader = loader
+        self._watch = list(watch)
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._index = index if index is not None else loader()
+        self.loaded_at = time.time()
+        self.reload_count = 0
+        self._mtimes = self._watched_mtimes()
+        self._stop = threading.Event()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._threads = []
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def index(self) -> IngredientIndex:
+        return self._index
+
+    def _watched_mtimes(self) -> tuple:
+        mtimes = []
+        for path in self._watch:
+            # SQLite writes go to the -wal file first in WAL mode
+            for p in (path, path + "-wal"):
+                try:
+                    mtimes.append(os.stat(p).st_mtime_ns)
+                except OSError:
+                    mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self):
+        # Build a new index and swap it in
+        # Only one reload runs at a time, queries are not blocked while the index is built.
+        with self._lock:
+            index = self._loader()
+            self._index = index
+            self.loaded_at = time.time()
+            self.reload_count += 1
+
+    def _watch_loop(self):
+        while not self._stop.wait(self._interval):
+            mtimes = self._watched_mtimes()
+            if mtimes == self._mtimes:
+                continue
+            self._mtimes = mtimes
+            try:
+                self.reload()
+            except Exception as e:
+                # Keep serving the old index, try again on the next change
+                print("Reloading the index failed: %s" % e)
+
+    def query(self, include: [str], exclude: [str] = (), threshold: float = 0.5) -> List[Tuple[str, list]]:
+        return self._index.query(include, threshold, exclude)
+
+    def handle(self, path: str) -> (int, dict):
+        # Returns (HTTP status, JSON body) for the request path
+        url = urlparse(path)
+        params = parse_qs(url.query)
+        if url.path == "/status":
+            return 200, {"desserts": len(self._index), "loaded_at": self.loaded_at, "reloads": self.reload_count}
+        if url.path != "/query":
+            return 404, {"error": "Unknown path %s" % url.path}
+        include = _terms(params.get("include", []))
+        exclude = _terms(params.get("exclude", []))
+        try:
+            threshold = float(params.get("threshold", ["0.5"])[-1])
+        except ValueError:
+            return 400, {"error": "Invalid threshold"}
+        # Also rejects inf and nan
+        if not (math.isfinite(threshold) and 0.0 <= threshold <= 1.0):
+            return 400, {"error": "The threshold must be between 0 and 1"}
+        start = time.perf_counter()
+        desserts = self.query(include, exclude, threshold)
+        return 200, {
+            "include": include,
+            "exclude": exclude,
+            "count": len(desserts),
+            "took_ms": (time.perf_counter() - start) * 1000.0,
+            "desserts": [{"title": title, "ingredients": ingredients_to_data(ingredients)}
+                         for title, ingredients in desserts]
+        }
+
+    def _handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                try:
+                    status, body = service.handle(self.path)
+                except Exception as e:
+                    # Answer instead of dropping the connection
+                    status, body = 500, {"error": "%s: %s" % (type(e).__name__, e)}
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "QueryService":
+        self._threads = [threading.Thread(target=self._server.serve_forever, name="query-service", daemon=True)]
+        if len(self._watch) > 0:
+            self._threads.append(threading.Thread(target=self._watch_loop, name="query-reload", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def serve_forever(self):
+        if len(self._watch) > 0:
+            threading.Thread(target=self._watch_loop, name="query-reload", daemon=True).start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,88 @@
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from .index import bigrams
+
+
+class BigramSimilarity:
+    # Bigram Jaccard similarity of many query terms against many names in one go
+    # The names and the terms are encoded as binary sparse vectors over the bigram vocabulary of
+    # the names. One sparse matrix product gives the shared bigram counts of every term and name
+    # pair, and the similarity follows from the set sizes:
+    #   jaccard = shared / (|term| + |name| - shared)
+    # Only the pairs that share a bigram are computed, the rest have a similarity of 0.
+    # The values are the same as with jaccard(bigrams(term), bigrams(name)).
+
+    def __init__(self, names: Sequence[str]):
+        self.names = list(names)
+        self._vocabulary = {}
+        matrix, self._name_sizes = self._encode(self.names, grow=True)
+        # Bigrams x names, so that the product with the term vectors is terms x names
+        self._names_t = matrix.T.tocsr()
+
+    def _encode(self, words: Iterable[str], grow: bool = False) -> (sparse.csr_matrix, np.ndarray):
+        # Returns the binary bigram vectors of the words and the bigram set sizes
+        # The bigrams that no name has are left out of the vectors but count in the sizes.
+        indptr = [0]
+        indices = []
+        sizes = []
+        vocabulary = self._vocabulary
+        for word in words:
+            grams = bigrams(word)
+            sizes.append(len(grams))
+            for gram in grams:
+                column = vocabulary.get(gram)
+                if column is None:
+                    if not grow:
+                        continue
+                    column = len(vocabulary)
+                    vocabulary[gram] = column
+                indices.append(column)
+            indptr.append(len(indices))
+        shape = (len(sizes), len(vocabulary))
+        matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=shape)
+        return matrix, np.array(sizes, dtype=np.int64)
+
+    def matrix(self, terms: Sequence[str]) -> sparse.csr_matrix:
+        # Similarity matrix of the terms (rows) and the names (columns)
+        encoded, term_sizes = self._encode(terms)
+        shared = encoded @ self._names_t
+        shared.sort_indices()
+        rows = np.repeat(np.arange(len(term_sizes)), np.diff(shared.indptr))
+        counts = shared.data.astype(np.int64)
+        union = term_sizes[rows] + self._name_sizes[shared.indices] - counts
+        return sparse.csr_matrix((counts / union, shared.indices, shared.indptr), shape=shared.shape)
+
+    def matches(self, terms: Sequence[str], threshold: float = 0.5,
+                top_k: Optional[int] = None) -> List[List[Tuple[int, float]]]:
+        # The names above the threshold for every term, as (name index, similarity) pairs
+        # The best matches come first, at most top_k of them per term if given.
+        similarity = self.matrix(terms)
+        rows = np.repeat(np.arange(similarity.shape[0]), np.diff(similarity.indptr))
+        keep = similarity.data > threshold
+        rows = rows[keep]
+        columns = similarity.indices[keep]
+        scores = similarity.data[keep]
+        # By term, then the best similarity first, ties in name order
+        order = np.lexsort((columns, -scores, rows))
+        rows, columns, scores = rows[order], columns[order], scores[order]
+        if top_k is not None:
+            # Rank of every match within its term
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side="left")
+            keep = rank < top_k
+            rows, columns, scores = rows[keep], columns[keep], scores[keep]
+        bounds = np.searchsorted(rows, np.arange(similarity.shape[0] + 1), side="left")
+        columns = columns.tolist()
+        scores = scores.tolist()
+        return [list(zip(columns[start:end], scores[start:end])) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def batch_similarity(terms: Sequence[str], names: Sequence[str], threshold: float = 0.5,
+                     top_k: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+    # The names matching every term, as (name, similarity) pairs with the best matches first
+    # Use BigramSimilarity directly to match several batches of terms against the same names.
+    similarity = BigramSimilarity(names)
+    return [[(similarity.names[i], score) for i, score in matches]
+            for matches in similarity.matches(terms, threshold, top_k)]
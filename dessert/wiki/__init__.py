@@ -1,2 +1,4 @@
+from .cache import DirectoryWikitextCache, SqliteWikitextCache, WikitextCache
+from .page import WikiPage
 from .parser import WikiParser
 from .source import WikiSource
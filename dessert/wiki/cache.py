@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from urllib.parse import quote
+
+
+class WikitextCache:
+    # Base class for the wikitext cache backends
+    # Pages are keyed by their canonical (normalized and redirected) title. The titles that
+    # were used to request the page are stored as aliases of the canonical title.
+
+    def get_many(self, titles: [str]) -> {str: (str, str)}:
+        # Returns a dict of requested title -> (canonical title, wikitext) for the cached titles
+        raise NotImplementedError
+
+    def get_revisions(self, titles: [str]) -> {str: (str, int, str)}:
+        # Returns a dict of requested title -> (canonical title, revision ID, revision timestamp)
+        # for the cached titles. Backends that don't track revisions return an empty dict.
+        return {}
+
+    def resolve(self, titles: [str]) -> {str: str}:
+        # Returns a dict of requested title -> canonical title for the titles that are known
+        # aliases, without reading the wikitext. Backends without aliases return an empty dict.
+        return {}
+
+    def put_many(self, pages: [(str, str, str, int, str)]):
+        # Stores a list of (requested title, canonical title, wikitext, revision ID, revision timestamp) tuples
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DirectoryWikitextCache(WikitextCache):
+    # The old naive filesystem cache, one file per page
+    # The filename will be the URLEncoded version of the canonical title, the aliases are kept
+    # in aliases.json. Files named after the requested title (the old layout) are still read.
+
+    def __init__(self, path: str = "wikitext"):
+        self._path = Path(path)
+        os.makedirs(self._path, exist_ok=True)
+        self._lock = threading.Lock()
+        try:
+            with open(self._path / "aliases.json", "r", encoding="utf-8") as f:
+                self._aliases = json.load(f)
+        except FileNotFoundError:
+            self._aliases = {}
+
+    def _read(self, title: str) -> str:
+        with open(self._path / ("%s.txt" % quote(title)), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def get_many(self, titles: [str]) -> {str: (str, str)}:
+        found = {}
+        for title in titles:
+            canonical = self._aliases.get(title, title)
+            try:
+                found[title] = (canonical, self._read(canonical))
+            except FileNotFoundError:
+                if canonical == title:
+                    continue
+                try:
+                    found[title] = (title, self._read(title))
+                except FileNotFoundError:
+                    pass
+        return found
+
+    def resolve(self, titles: [str]) -> {str: str}:
+        return {title: self._aliases[title] for title in titles if title in self._aliases}
+
+    def put_many(self, pages: [(str, str, str, int, str)]):
+        with self._lock:
+            for alias, title, content, _, _ in pages:
+                with open(self._path / ("%s.txt" % quote(title)), "w", encoding="utf-8") as f:
+                    f.write(content)
+            aliases = {alias: title for alias, title, _, _, _ in pages
+                       if alias != title and self._aliases.get(alias) != title}
+            if len(aliases) > 0:
+                self._aliases = {**self._aliases, **aliases}
+                with open(self._path / "aliases.json", "w", encoding="utf-8") as f:
+                    json.dump(self._aliases, f)
+
+
+class SqliteWikitextCache(WikitextCache):
+    # Single-file cache backed by SQLite
+    # The wikitext is stored zlib-compressed and a whole batch is looked up with a single query.
+
+    # Bumped whenever the schema changes, see _migrate()
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str = "wikitext.db"):
+        # The connection is shared between the fetcher threads, access is serialized with a lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, content BLOB NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, title TEXT NOT NULL)")
+            self._migrate()
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # Version 1: store the revision of each page for incremental refreshes
+            # Pages cached before this have no revision and are always refreshed.
+            self._db.execute("ALTER TABLE pages ADD COLUMN revid INTEGER")
+            self._db.execute("ALTER TABLE pages ADD COLUMN timestamp TEXT")
+        self._db.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def get_many(self, titles: [str]) -> {str: (str, str)}:
+        found = {}
+        with self._lock:
+            # The titles are passed as a single JSON array parameter so that the whole batch
+            # is resolved (through the aliases) in one statement
+            rows = self._db.execute(
+                "SELECT q.alias, p.title, p.content FROM "
+                "(SELECT value AS alias, COALESCE(a.title, value) AS title "
+                "FROM json_each(?) LEFT JOIN aliases a ON a.alias = value) q "
+                "JOIN pages p ON p.title = q.title",
+                (json.dumps(list(titles)),)).fetchall()
+        for alias, title, content in rows:
+            found[alias] = (title, zlib.decompress(content).decode("utf-8"))
+        return found
+
+    def get_revisions(self, titles: [str]) -> {str: (str, int, str)}:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT q.alias, p.title, p.revid, p.timestamp FROM "
+                "(SELECT value AS alias, COALESCE(a.title, value) AS title "
+                "FROM json_each(?) LEFT JOIN aliases a ON a.alias = value) q "
+                "JOIN pages p ON p.title = q.title",
+                (json.dumps(list(titles)),)).fetchall()
+        return {alias: (title, revid, timestamp) for alias, title, revid, timestamp in rows}
+
+    def resolve(self, titles: [str]) -> {str: str}:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT a.alias, a.title FROM json_each(?) JOIN aliases a ON a.alias = value",
+                (json.dumps(list(titles)),)).fetchall()
+        return dict(rows)
+
+    def put_many(self, pages: [(str, str, str, int, str)]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pages (title, content, revid, timestamp) VALUES (?, ?, ?, ?)",
+                [(title, zlib.compress(content.encode("utf-8")), revid, timestamp)
+                 for _, title, content, revid, timestamp in pages])
+            self._db.executemany(
+                "INSERT OR REPLACE INTO aliases (alias, title) VALUES (?, ?)",
+                [(alias, title) for alias, title, _, _, _ in pages if alias != title])
+
+    def pages(self) -> [(str, str)]:
+        # All cached pages as (canonical title, wikitext)
+        with self._lock:
+            rows = self._db.execute("SELECT title, content FROM pages ORDER BY title").fetchall()
+        return [(title, zlib.decompress(content).decode("utf-8")) for title, content in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+# Local stand-in for the MediaWiki action API, for load testing the fetcher without Wikipedia
+# The pages are read from a directory of "<URL encoded title>.txt" files, the same layout as
+# DirectoryWikitextCache uses. Pages starting with "#REDIRECT [[Target]]" are redirects.
+#
+# Supported: action=query with titles=..., prop=revisions (rvprop ids|timestamp|content, rvcontinue)
+# and prop=info, redirects=1, title normalization and missing pages. Responses can be delayed,
+# throttled with HTTP 429 and cut into several continued responses.
+# list=categorymembers (cmtitle, cmtype, cmlimit, cmcontinue) lists the pages that link to the
+# category with [[Category:...]], like in MediaWiki. Subcategories are "Category:..." pages.
+#
+# Usage:
+#   python -m dessert.wiki.fakewiki PAGE_DIR --port 8080 --latency 0.05 --throttle-every 10
+# or in code:
+#   with FakeMediaWiki(page_dir) as wiki:
+#       ws = WikiSource(api_url=wiki.url)
+
+_REDIRECT_RE = re.compile(r"^\s*#REDIRECT\s*\[\[([^\]|#]+)", re.IGNORECASE)
+_CATEGORY_RE = re.compile(r"\[\[\s*Category\s*:\s*([^\]|#]+)", re.IGNORECASE)
+
+
+def normalize_title(title: str) -> str:
+    # MediaWiki title normalization (the parts that matter here)
+    title = " ".join(title.replace("_", " ").split())
+    return title[:1].upper() + title[1:]
+
+
+def write_pages(path: str, pages: [(str, str)]):
+    # Writes (title, wikitext) pages to a directory that FakeMediaWiki can serve
+    os.makedirs(path, exist_ok=True)
+    for title, wikitext in pages:
+        with open(Path(path) / ("%s.txt" % quote(title, safe="")), "w", encoding="utf-8") as f:
+            f.write(wikitext)
+
+
+class _Page:
+
+    def __init__(self, pageid: int, title: str, content: str):
+        self.pageid = pageid
+        self.title = title
+        self.content = content
+        # The revision ID changes whenever the content changes
+        self.revid = pageid * 100000 + zlib.crc32(content.encode("utf-8")) % 100000
+        match = _REDIRECT_RE.match(content)
+        self.redirect = normalize_title(match.group(1)) if match else None
+        self.ns = 14 if title.startswith("Category:") else 0
+        self.categories = {"Category:" + normalize_title(name) for name in _CATEGORY_RE.findall(content)}
+
+
+class FakeMediaWiki:
+
+    def __init__(self, path: str, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 throttle_every: int = 0, retry_after: int = 1, max_response_bytes: int = 0):
+        # latency: seconds to wait before every response
+        # throttle_every: answer every Nth request with HTTP 429 (0 = never)
+        # max_response_bytes: content size after which the rest of the pages are left for a
+        #   continuation request, like $wgAPIMaxResultSize (0 = unlimited)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.max_response_bytes = max_response_bytes
+        self.request_count = 0
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._members = {}
+        self._load(path)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def _load(self, path: str):
+        files = sorted((unquote(name[:-4]), name) for name in os.listdir(path) if name.endswith(".txt"))
+        for pageid, (title, name) in enumerate(files, 1):
+            with open(Path(path) / name, "r", encoding="utf-8") as f:
+                content = f.read()
+            title = normalize_title(title)
+            self._pages[title] = _Page(pageid, title, content)
+        for page in self._pages.values():
+            for category in page.categories:
+                self._members.setdefault(category, []).append(page)
+        for members in self._members.values():
+            members.sort(key=lambda page: page.title)
+
+    def __len__(self):
+        return len(self._pages)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d/w/api.php" % (host, port)
+
+    def start(self) -> "FakeMediaWiki":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fakewiki", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _resolve(self, titles: [str], follow_redirects: bool):
+        # Returns the normalized and redirects lists and the resolved titles in order
+        normalized = []
+        redirects = []
+        resolved = []
+        for title in titles:
+            norm = normalize_title(title)
+            if norm != title:
+                normalized.append({"fromencoded": False, "from": title, "to": norm})
+            page = self._pages.get(norm)
+            if follow_redirects and page is not None and page.redirect is not None:
+                redirects.append({"from": norm, "to": page.redirect})
+                norm = page.redirect
+            if norm not in resolved:
+                resolved.append(norm)
+        return normalized, redirects, resolved
+
+    def _query(self, params: dict) -> dict:
+        titles = [t for t in params.get("titles", "").split("|") if t]
+        props = params.get("prop", "").split("|")
+        normalized, redirects, resolved = self._resolve(titles, params.get("redirects") == "1")
+        rvprop = params.get("rvprop", "ids|timestamp|flags|comment|user").split("|")
+        # rvcontinue is "<pageid>|<revid>" of the first page that wasn't returned yet
+        start_pageid = 0
+        if "rvcontinue" in params:
+            start_pageid = int(params["rvcontinue"].split("|")[0])
+
+        pages = []
+        response_bytes = 0
+        continue_from = None
+        for title in sorted(resolved, key=lambda t: self._pages[t].pageid if t in self._pages else 0):
+            page = self._pages.get(title)
+            if page is None:
+                pages.append({"ns": 0, "title": title, "missing": True})
+                continue
+            entry = {"pageid": page.pageid, "ns": 0, "title": page.title}
+            if "info" in props:
+                entry.update({"contentmodel": "wikitext", "lastrevid": page.revid, "length": len(page.content)})
+            if "revisions" in props and page.pageid >= start_pageid and continue_from is None:
+                size = len(page.content.encode("utf-8")) if "content" in rvprop else 0
+                if self.max_response_bytes and response_bytes > 0 and response_bytes + size > self.max_response_bytes:
+                    # Too much for this response, the client has to continue from here
+                    continue_from = page
+                else:
+                    response_bytes += size
+                    revision = {}
+                    if "ids" in rvprop:
+                        revision.update({"revid": page.revid, "parentid": 0})
+                    if "timestamp" in rvprop:
+                        revision["timestamp"] = "2020-01-01T00:00:00Z"
+                    if "content" in rvprop:
+                        revision["slots"] = {"main": {"contentmodel": "wikitext", "contentformat": "text/x-wiki",
+                                                      "content": page.content}}
+                    entry["revisions"] = [revision]
+            pages.append(entry)
+
+        query = {"pages": pages}
+        if normalized:
+            query["normalized"] = normalized
+        if redirects:
+            query["redirects"] = redirects
+        result = {"query": query}
+        if continue_from is not None:
+            result["continue"] = {"rvcontinue": "%d|%d" % (continue_from.pageid, continue_from.revid),
+                                  "continue": "||"}
+        else:
+            result["batchcomplete"] = True
+        return result
+
+    def _category_members(self, params: dict) -> dict:
+        members = self._members.get(normalize_title(params.get("cmtitle", "")), [])
+        types = params.get("cmtype", "page|subcat|file").split("|")
+        members = [page for page in members if ("subcat" if page.ns == 14 else "page") in types]
+        limit = params.get("cmlimit", "10")
+        limit = 500 if limit == "max" else min(int(limit), 500)
+        # cmcontinue is the index of the next member
+        start = int(params.get("cmcontinue", "0"))
+        props = params.get("cmprop", "ids|title").split("|")
+        result_members = []
+        for page in members[start:start + limit]:
+            entry = {"ns": page.ns, "title": page.title}
+            if "ids" in props:
+                entry["pageid"] = page.pageid
+            if "type" in props:
+                entry["type"] = "subcat" if page.ns == 14 else "page"
+            result_members.append(entry)
+        result = {"query": {"categorymembers": result_members}}
+        if start + limit < len(members):
+            result["continue"] = {"cmcontinue": str(start + limit), "continue": "-||"}
+        else:
+            result["batchcomplete"] = True
+        return result
+
+    def handle(self, params: dict) -> (int, dict, dict):
+        # Returns (HTTP status, headers, JSON body) for the request parameters
+        with self._lock:
+            self.request_count += 1
+            throttle = self.throttle_every > 0 and self.request_count % self.throttle_every == 0
+            if throttle:
+                self.throttled_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if throttle:
+            return 429, {"Retry-After": str(self.retry_after)}, {
+                "error": {"code": "ratelimited", "info": "You've exceeded your rate limit."}}
+        if params.get("action") != "query":
+            return 200, {}, {"error": {"code": "badvalue", "info": "Only action=query is supported."}}
+        if params.get("list") == "categorymembers":
+            return 200, {}, self._category_members(params)
+        return 200, {}, self._query(params)
+
+    def _handler_class(self):
+        wiki = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                status, headers, body = wiki.handle(params)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m dessert.wiki.fakewiki",
+                                     description="Serve a directory of wikitext files with a fake MediaWiki API")
+    parser.add_argument("path", help="directory of <URL encoded title>.txt files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with HTTP 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds of the 429 responses")
+    parser.add_argument("--max-response-bytes", type=int, default=0,
+                        help="continue the response after this much content (default: unlimited)")
+    args = parser.parse_args()
+
+    wiki = FakeMediaWiki(args.path, args.host, args.port, args.latency, args.throttle_every,
+                         args.retry_after, args.max_response_bytes)
+    print("Serving %d pages at %s" % (len(wiki), wiki.url))
+    try:
+        wiki.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import re
+from typing import Optional
+
+import wikitextparser as wtp
+
+# Names of the infobox templates that contain the ingredients (lowercase)
+INFOBOX_NAMES = ["infobox food", "infobox prepared food"]
+
+# Cheap pre-scan for the infobox templates in the raw wikitext
+# This matches at least everything that WikiParser.get_dessert_ingredients would find
+# with the full parse tree, so pages without a match can be skipped without parsing.
+_INFOBOX_RE = re.compile(r"\{\{\s*infobox (?:prepared )?food\s*[|}]", re.IGNORECASE)
+
+# Tokens that matter when looking for the end of a template in the raw wikitext
+_SPAN_TOKEN_RE = re.compile(r"\{\{|\}\}|\[\[|\]\]|<!--|<([a-zA-Z]+)\b[^<>]*?(/?)>")
+# Tags whose contents wikitextparser keeps apart from the surrounding template
+_EXTENSION_TAGS = frozenset([
+    "categorytree", "gallery", "imagemap", "includeonly", "indicator", "inputbox", "noinclude",
+    "onlyinclude", "poem", "ref", "references", "section", "ce", "charinsert", "chem", "graph",
+    "hiero", "languages", "mapframe", "maplink", "math", "nowiki", "pagelist", "pagequality", "pages",
+    "pre", "score", "source", "syntaxhighlight", "templatedata", "templatestyles", "timeline"
+])
+_EXTENSION_TAG_RE = re.compile(r"<(?:%s)\b" % "|".join(sorted(_EXTENSION_TAGS)), re.IGNORECASE)
+
+
+def find_infobox(wikitext: wtp.WikiText) -> Optional[wtp.Template]:
+    # Get the first food infobox template of a parsed page
+    for template in wikitext.templates:
+        if template.name.strip().lower() in INFOBOX_NAMES:
+            return template
+    return None
+
+
+def _template_end(raw: str, start: int) -> Optional[int]:
+    # Find the end of the template starting at raw[start] by counting the braces
+    # Comments and the contents of extension tags (<ref>, <nowiki>, ...) are skipped like
+    # wikitextparser does. Returns None if the end is not certain, e.g. "}}" inside a link.
+    depth = 0
+    links = 0
+    pos = start
+    while True:
+        m = _SPAN_TOKEN_RE.search(raw, pos)
+        if m is None:
+            return None
+        token = m.group()
+        pos = m.end()
+        if token == "{{":
+            depth += 1
+        elif token == "}}":
+            if links > 0:
+                return None
+            depth -= 1
+            if depth == 0:
+                return pos
+        elif token == "[[":
+            links += 1
+        elif token == "]]":
+            links = max(links - 1, 0)
+        elif token == "<!--":
+            end = raw.find("-->", pos)
+            if end < 0:
+                return None
+            pos = end + 3
+        else:
+            name = m.group(1).lower()
+            if name in _EXTENSION_TAGS and not m.group(2):
+                close = re.compile(r"</%s\s*>" % name, re.IGNORECASE).search(raw, pos)
+                if close is None:
+                    return None
+                pos = close.end()
+
+
+def _comment_spans(raw: str, end: int) -> [(int, int)]:
+    spans = []
+    pos = raw.find("<!--", 0, end)
+    while pos >= 0:
+        close = raw.find("-->", pos + 4)
+        close = len(raw) if close < 0 else close + 3
+        spans.append((pos, close))
+        pos = raw.find("<!--", close, end)
+    return spans
+
+
+class WikiPage:
+    # A wiki page that keeps only the raw wikitext
+    # The wikitext is parsed on demand, the parse tree is not kept around.
+
+    def __init__(self, title: str, raw: str):
+        self.title = title
+        self.raw = raw
+
+    @property
+    def wikitext(self) -> wtp.WikiText:
+        return wtp.parse(self.raw)
+
+    def infobox(self) -> Optional[wtp.Template]:
+        # Get the first food infobox template of the page, same as find_infobox(self.wikitext)
+        # The infobox is located in the raw wikitext and only its span is parsed, as it's a tiny
+        # part of a long article. Unusual markup around it falls back to parsing the whole page.
+        m = _INFOBOX_RE.search(self.raw)
+        if m is None:
+            return None
+        start = m.start()
+        # Infoboxes in comments or <nowiki> etc. don't count and "{{{" is a template parameter
+        if self.raw[start - 1:start] == "{" or _EXTENSION_TAG_RE.search(self.raw, 0, start) \
+                or any(s <= start < e for s, e in _comment_spans(self.raw, start)):
+            return find_infobox(self.wikitext)
+        end = _template_end(self.raw, start)
+        # Template parameters ("{{{1}}}") don't pair up like the braces of templates
+        if end is None or self.raw.find("{{{", start, end) >= 0:
+            return find_infobox(self.wikitext)
+        templates = wtp.parse(self.raw[start:end]).templates
+        if len(templates) > 0 and templates[0].span == (0, end - start) \
+                and templates[0].name.strip().lower() in INFOBOX_NAMES:
+            return templates[0]
+        return find_infobox(self.wikitext)
+
+    def __repr__(self):
+        return "<WikiPage \"%s\", %d chars>" % (self.title, len(self.raw))
@@ -1,31 +1,19 @@
+import html
+import re
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Union
 
 import wikitextparser as wtp
 from bs4 import BeautifulSoup
 from dessert.model import Ingredient
 
+from .page import WikiPage, find_infobox
 
-# TODO: Logging
-
-# Monkey patch wikitextparser WikiText with a couple helpers
-# =============================================================================
-
-
-def _wtp_get_template(self, template_name: str) -> Optional[wtp.Template]:
-    for temp in self.templates:
-        if temp.name == template_name:
-            return temp
-    return None
-
-
-def _wtp_has_template(self, template_name: str) -> bool:
-    return self.get_template(template_name) is not None
 
+# TODO: Logging
 
-wtp.WikiText.get_template = _wtp_get_template
-wtp.WikiText.has_template = _wtp_has_template
-# =============================================================================
+# List templates in the main ingredient value, matched by their exact name
+_LIST_TEMPLATES = frozenset(["flatlist", "ubl", "plainlist"])
 
 
 class State(Enum):
@@ -42,22 +30,106 @@ class State(Enum):
     possible_split = 10
 
 
-class WikiParser:
+_POSSIBLE_STATES = frozenset([State.possible_link, State.possible_link_end,
+                              State.possible_template, State.possible_template_end])
+_LINK_STATES = frozenset([State.possible_link, State.in_link, State.possible_link_end, State.link_ended])
+_TEMPLATE_STATES = frozenset([State.possible_template, State.in_template,
+                              State.possible_template_end, State.template_ended])
+
+# Tags that are changed to commas before parsing
+_BR_TAGS = ["<br>", "<BR>", "<br />", "<BR />", "<br/>", "</BR>", "\n"]
+
+# Strings that indicate a split, see WikiParser._in_split_list()
+_SPLIT_STRINGS = frozenset([" /", " or", " and", " and/or"])
+
+# Well-formed <ref> tags that the scanner can remove without BeautifulSoup
+_REF_TAG_RE = re.compile(
+    r"<ref(?:\s+[\w-]+\s*=\s*(?:\"[^\"<>&]*\"|'[^'<>&]*'))*\s*(?:/>|>[^<&]*</ref>)")
+# Whitespace characters of the HTML parser
+_HTML_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+# Runs of characters the scanner copies as-is in the given states
+# In the normal and possible_split states everything but these characters is plain text,
+# and ")" is plain text too when there are no open lists (or the state is possible_split).
+_TEXT_RUN_RE = re.compile(r"[^\[{ ,(]+")
+_TEXT_RUN_IN_LIST_RE = re.compile(r"[^\[{ ,()]+")
+_LINK_RUN_RE = re.compile(r"[^\]]+")
+_TEMPLATE_RUN_RE = re.compile(r"[^}]+")
+# Link contents that need wikitextparser to get the same link text
+_COMPLEX_LINK_RE = re.compile(r"[\[\]{}<>\r\n]")
+
+# Markup handled by the flat fallback parser, see WikiParser._flat_ingredients_list()
+_FLAT_REF_RE = re.compile(r"<ref[^<>]*/>|<ref[^<>]*>.*?</ref\s*>", re.IGNORECASE | re.DOTALL)
+_FLAT_LINK_RE = re.compile(r"\[\[(?:[^\[\]|]*\|)?([^\[\]]*)\]\]")
+_FLAT_BRACES_RE = re.compile(r"\{\{|\}\}")
+_FLAT_MARKUP_RE = re.compile(r"<[^<>]*>|'{2,}|[\[\]{}()]")
+_FLAT_SPLIT_RE = re.compile(r",|\s(?:and/or|and|or|/)\s")
+
+
+def _strip_ref_tags(wt: str) -> Optional[str]:
+    # Fast equivalent of the BeautifulSoup tag removal for text where the only tags are <ref> tags
+    # BeautifulSoup turns text nodes that contain only whitespace into a single space (or newline).
+    # Returns None if the text contains other markup, which needs BeautifulSoup.
+    parts = []
+    for part in _REF_TAG_RE.split(wt):
+        if len(part) == 0:
+            continue
+        if len(part.strip(_HTML_SPACES)) == 0:
+            part = "\n" if "\n" in part else " "
+        parts.append(part)
+    stripped = "".join(parts)
+    if "<" in stripped or "&" in stripped:
+        return None
+    return stripped or wt
+
+
+def _link_text(link: str) -> str:
+    # Get the text of a "[[title|text]]" link the same way as with wikitextparser
+    inner = link[2:-2]
+    if not link.startswith("[[") or _COMPLEX_LINK_RE.search(inner):
+        wt_link = wtp.parse(link).wikilinks[0]
+        return wt_link.text or wt_link.title
+    target, _, text = inner.partition("|")
+    return text or target.partition("#")[0]
+
 
-    def __init__(self):
-        pass
+class WikiParser:
+    # Ingredient list parsing engines
+    # "state_machine" is the original character by character parser, "scanner" gives the same
+    # results but copies plain text in runs and doesn't need BeautifulSoup or wikitextparser for
+    # the common cases.
+    ENGINES = ["state_machine", "scanner"]
+    # Bump when the parsing results change, this invalidates the cached results
+    VERSION = 4
+
+    def __init__(self, engine: str = "scanner", max_depth: int = 32, max_length: int = 20000, max_nodes: int = 2000):
+        # Limits for a single ingredient list, lists over them are parsed as a flat list instead:
+        # max_length: characters in the wikitext of the list
+        # max_depth: "(" in the list, which also limits how deep the sublists can nest
+        #   The state_machine engine strips the tags from the whole text again for every "(", so
+        #   it's their count that is limited. Both engines use the same limit to give the same
+        #   results.
+        # max_nodes: ingredients in the list, sublists included, scanner only
+        if engine not in WikiParser.ENGINES:
+            raise ValueError("Unknown parser engine \"%s\"" % engine)
+        self.engine = engine
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.max_nodes = max_nodes
+
+    @property
+    def version(self) -> str:
+        # Both engines give the same results, so the engine is not part of the version
+        # The limits change the results of the lists that go over them.
+        return "%d-%d-%d-%d" % (WikiParser.VERSION, self.max_depth, self.max_length, self.max_nodes)
 
     @staticmethod
     def _trim_wikitext(wt):
         return wt.replace(r"{{Non breaking hyphen}}", "-")
 
     def _trim_extra_wikitext(self, ingredients: [Ingredient]) -> [Ingredient]:
-        trimmed = []
-        for ingredient in ingredients:
-            new_name = WikiParser._trim_wikitext(ingredient.name)
-            new_ingredients = self._trim_extra_wikitext(ingredient.ingredients)
-            trimmed.append(Ingredient(new_name, new_ingredients))
-        return trimmed
+        # Only the nodes that change are copied
+        return [ingredient.map_names(WikiParser._trim_wikitext) for ingredient in ingredients]
 
     def _add_ingredient(self, l, name, sub):
         name = name.strip()
@@ -74,9 +146,7 @@ class WikiParser:
 
     def _parse_wikitext_ingredients_list(self, wt, idx=0, open_lists=0):
         # Change <br> tags and newlines to commas to split the ingredients after them
-        remove_list = ["<br>", "<BR>", "<br />",
-                       "<BR />", "<br/>", "</BR>", "\n"]
-        for entry in remove_list:
+        for entry in _BR_TAGS:
             wt = wt.replace(entry, ",")
 
         # Remove other tags (<ref> etc.) before additional parsing
@@ -258,17 +328,283 @@ class WikiParser:
 
         return ingredients, idx
 
-    def _get_ingredients_from_infobox(self, infobox: wtp.WikiText):
+    def _parse_ingredients_list(self, wt: str) -> [Ingredient]:
+        # Pathological values degrade to a flat list instead of failing
+        # Each "(" costs a BeautifulSoup pass and a level of recursion in the state machine
+        if len(wt) > self.max_length or wt.count("(") > self.max_depth:
+            return self._flat_ingredients_list(wt)
+        if self.engine == "scanner":
+            ingredients = self._scan_wikitext_ingredients_list(wt)
+        else:
+            try:
+                ingredients = self._parse_wikitext_ingredients_list(wt)[0]
+            except RecursionError:
+                ingredients = None
+        if ingredients is None:
+            return self._flat_ingredients_list(wt)
+        return ingredients
+
+    def _flat_ingredients_list(self, wt: str) -> [Ingredient]:
+        # Rough flat list of the ingredient names, without sublists
+        # Every step is a single pass over the (truncated) text, so this stays linear whatever the
+        # input looks like.
+        wt = wt[:self.max_length]
+        for entry in _BR_TAGS:
+            wt = wt.replace(entry, ",")
+        wt = _FLAT_REF_RE.sub("", wt)
+        wt = _FLAT_LINK_RE.sub(r"\1", wt)
+        # Keep only the text outside the templates
+        parts = []
+        depth = 0
+        pos = 0
+        for m in _FLAT_BRACES_RE.finditer(wt):
+            if depth == 0:
+                parts.append(wt[pos:m.start()])
+            depth = depth + 1 if m.group() == "{{" else max(depth - 1, 0)
+            pos = m.end()
+        if depth == 0:
+            parts.append(wt[pos:])
+        wt = html.unescape(_FLAT_MARKUP_RE.sub(" ", "".join(parts)))
+        ingredients = []
+        for name in _FLAT_SPLIT_RE.split(wt):
+            name = " ".join(name.split())
+            if len(name) > 0:
+                ingredients.append(Ingredient(name, []))
+                if len(ingredients) >= self.max_nodes:
+                    break
+        return ingredients
+
+    def _scan_wikitext_ingredients_list(self, wt: str) -> Optional[List[Ingredient]]:
+        # Same preprocessing as in _parse_wikitext_ingredients_list
+        wt_orig = wt
+        for entry in _BR_TAGS:
+            wt = wt.replace(entry, ",")
+        stripped = _strip_ref_tags(wt)
+        if stripped is None:
+            # Markup that only BeautifulSoup handles correctly
+            soup = BeautifulSoup(wt, "html.parser")
+            stripped = "".join(soup.findAll(text=True, recursive=False)) or wt
+            if "<" in stripped or "&" in stripped:
+                # The state machine strips the tags again for every sublist, which changes text
+                # like this, so only the state machine itself gives the same result. The number of
+                # "(" (BeautifulSoup passes) was already limited in _parse_ingredients_list.
+                try:
+                    return self._parse_wikitext_ingredients_list(wt_orig)[0]
+                except RecursionError:
+                    return None
+            # Otherwise stripping the tags again doesn't change the text and it can be scanned
+        wt = stripped.replace("'''''", "").replace("'''", "").replace("''", "")
+        return self._scan_ingredients(wt)
+
+    def _scan_ingredients(self, wt: str) -> Optional[List[Ingredient]]:
+        # Scanner version of the state machine in _parse_wikitext_ingredients_list
+        # The state transitions are the same, but runs of characters that don't change the state
+        # are copied at once. The preprocessing is not repeated for the sublists as the text
+        # doesn't change anymore at that point.
+        # The sublists are parsed with an explicit stack instead of recursion: "(" saves the
+        # variables of the current list to the stack and the end of the sublist restores them.
+        # Returns None if the sublists nest deeper than max_depth or there are more than
+        # max_nodes ingredients.
+        stack = []
+        nodes = 0
+        idx = 0
+        open_lists = 0
+        state = State.normal
+        ingredients = []
+        temp = ""
+        link_temp = ""
+        template_temp = ""
+        split_temp = ""
+        sublist = []
+        split_now = False
+        length = len(wt)
+
+        while True:
+            if idx >= length:
+                # End of the text, finish the current list
+                if split_temp:
+                    temp += split_temp
+                if temp:
+                    ingredients = self._add_ingredient(ingredients, temp, sublist)
+                    nodes += 1
+                if len(stack) == 0:
+                    return ingredients
+                result = ingredients
+                (state, ingredients, temp, link_temp, template_temp, split_temp, split_now,
+                 open_lists) = stack.pop()
+                sublist = result
+                idx += 1
+                continue
+
+            # Copy plain text runs
+            if state is State.normal:
+                m = (_TEXT_RUN_IN_LIST_RE if open_lists > 0 else _TEXT_RUN_RE).match(wt, idx)
+                if m:
+                    temp += m.group()
+                    idx = m.end()
+                    continue
+            elif state is State.possible_split:
+                m = _TEXT_RUN_RE.match(wt, idx)
+                if m:
+                    split_temp += m.group()
+                    idx = m.end()
+                    continue
+            elif state is State.in_link:
+                m = _LINK_RUN_RE.match(wt, idx)
+                if m:
+                    link_temp += m.group()
+                    idx = m.end()
+                    continue
+            elif state is State.in_template:
+                m = _TEMPLATE_RUN_RE.match(wt, idx)
+                if m:
+                    template_temp += m.group()
+                    idx = m.end()
+                    continue
+
+            c = wt[idx]
+            if c == "[":
+                if state is State.possible_link:
+                    state = State.in_link
+                elif state is not State.in_link and state is not State.in_template:
+                    state = State.possible_link
+                    link_temp = ""
+            elif c == "]":
+                if state is State.possible_link_end:
+                    state = State.link_ended
+                elif state is State.in_link:
+                    state = State.possible_link_end
+            elif c == "{":
+                if state is State.possible_template:
+                    state = State.in_template
+                elif state is not State.in_template and state is not State.in_link:
+                    state = State.possible_template
+                    template_temp = ""
+            elif c == "}":
+                if state is State.possible_template_end:
+                    state = State.template_ended
+                elif state is State.in_template:
+                    state = State.possible_template_end
+            elif state in _POSSIBLE_STATES:
+                state = State.normal
+                if link_temp:
+                    temp += link_temp
+                    link_temp = ""
+                elif template_temp:
+                    temp += template_temp
+                    template_temp = ""
+
+            if state is not State.possible_split and split_temp:
+                temp += split_temp
+                split_temp = ""
+
+            if c == " " and state is State.possible_split:
+                if split_temp in _SPLIT_STRINGS:
+                    split_now = True
+                else:
+                    temp += split_temp
+                    split_temp = c
+                    idx += 1
+                    continue
+            elif c == " " and state is State.normal:
+                state = State.possible_split
+                split_temp = c
+                idx += 1
+                continue
+
+            if split_now or (c == "," and (state is State.normal or state is State.possible_split)):
+                state = State.normal
+                if split_temp and split_temp not in _SPLIT_STRINGS:
+                    temp += split_temp
+                split_temp = ""
+                ingredients = self._add_ingredient(ingredients, temp, sublist)
+                nodes += 1
+                if nodes > self.max_nodes:
+                    return None
+                temp = ""
+                sublist = []
+                idx += 1
+                split_now = False
+                continue
+
+            if c == "(" and (state is State.normal or state is State.possible_split):
+                # Start a sublist, the sublist of the current ingredient is set when it ends
+                temp += split_temp
+                stack.append((State.normal, ingredients, temp, link_temp, template_temp, "", split_now,
+                              open_lists))
+                if len(stack) > self.max_depth:
+                    return None
+                state = State.normal
+                ingredients = []
+                temp = ""
+                link_temp = ""
+                template_temp = ""
+                split_temp = ""
+                sublist = []
+                split_now = False
+                open_lists += 1
+                idx += 1
+                continue
+
+            if open_lists > 0 and c == ")" and state is State.normal:
+                open_lists -= 1
+                ingredients = self._add_ingredient(ingredients, temp, sublist)
+                nodes += 1
+                if nodes > self.max_nodes:
+                    return None
+                temp = ""
+                sublist = []
+                if open_lists == 0:
+                    # End of the sublist, continue the parent list after the ")"
+                    result = ingredients
+                    (state, ingredients, temp, link_temp, template_temp, split_temp, split_now,
+                     open_lists) = stack.pop()
+                    sublist = result
+                idx += 1
+                continue
+
+            if state in _LINK_STATES:
+                link_temp += c
+            elif state in _TEMPLATE_STATES:
+                template_temp += c
+            elif state is State.possible_split:
+                split_temp += c
+            else:
+                temp += c
+            idx += 1
+
+            if state is State.link_ended:
+                temp += _link_text(link_temp)
+                link_temp = ""
+                state = State.normal
+            elif state is State.template_ended:
+                template_temp = ""
+                state = State.normal
+
+    @staticmethod
+    def _list_templates(wt_str: str) -> {str: wtp.Template}:
+        # Get the first flatlist, ubl and plainlist templates of the wikitext, in one pass
+        found = {}
+        if "{{" not in wt_str:
+            return found
+        for template in wtp.parse(wt_str).templates:
+            name = template.name
+            if name in _LIST_TEMPLATES and name not in found:
+                found[name] = template
+        return found
+
+    def _get_ingredients_from_infobox(self, infobox: wtp.Template):
         # Get ingredient wikitext string from the infobox template
-        if not infobox.has_arg("main_ingredient"):
+        # get_arg() gives the last main_ingredient argument, like MediaWiki uses
+        arg = infobox.get_arg("main_ingredient")
+        if arg is None:
             return []
-        wt_str = infobox.get_arg("main_ingredient").value.strip()
-        # Parse the wikitext into a WikiText object
-        wt = wtp.parse(wt_str)
+        wt_str = arg.value.strip()
         # Try to get possible templates from the wikitext
-        flatlist = wt.get_template("flatlist")
-        ubl = wt.get_template("ubl")
-        plainlist = wt.get_template("plainlist")
+        templates = self._list_templates(wt_str)
+        flatlist = templates.get("flatlist")
+        ubl = templates.get("ubl")
+        plainlist = templates.get("plainlist")
         # If we found matching list templates, parse them directly
         if flatlist or plainlist:
             lst = flatlist or plainlist
@@ -276,25 +612,26 @@ class WikiParser:
             list_items = lst.get_lists()[0].items
             # HACK: Join with commas and parse with our own wikitext parser to handle links and templates correctly
             wt_str = ",".join(list_items)
-            return self._parse_wikitext_ingredients_list(wt_str)[0]
+            return self._parse_ingredients_list(wt_str)
         if ubl:
             # Parse ubl list
             # HACK: Join with commas and parse with our own wikitext parser to handle links and templates correctly
             wt_str = ",".join([a.value.strip() for a in ubl.arguments])
-            return self._parse_wikitext_ingredients_list(wt_str)[0]
+            return self._parse_ingredients_list(wt_str)
         # Parse the wikitext ingredients
-        return self._parse_wikitext_ingredients_list(wt_str)[0]
+        return self._parse_ingredients_list(wt_str)
 
-    def get_dessert_ingredients(self, wikitext: wtp.WikiText) -> [Ingredient]:
+    def get_dessert_ingredients(self, wikitext: Union[WikiPage, wtp.WikiText]) -> [Ingredient]:
         # Not all dessert pages follow the same structure
         # The best pages are those that use the "infobox prepared food" or "infobox food" templates
         # Check if the page contains either "infobox food" or "infobox prepared food" templates
-        infobox_list: [wtp.Template] = [
-            t for t in wikitext.templates if t.name.strip().lower() in ["infobox food", "infobox prepared food"]
-        ]
-        if len(infobox_list) > 0:
+        if isinstance(wikitext, WikiPage):
+            # Only the infobox is parsed, most pages don't have one at all
+            infobox = wikitext.infobox()
+        else:
+            infobox = find_infobox(wikitext)
+        if infobox is not None:
             # Infobox found, parsing it
-            infobox = infobox_list[0]
             ingredients = self._get_ingredients_from_infobox(infobox)
             if len(ingredients) > 0:
                 return self._trim_extra_wikitext(ingredients)
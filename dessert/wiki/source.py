@@ -1,40 +1,192 @@
-import os
-from pathlib import Path
-from urllib.parse import quote
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
 import requests
 import wikitextparser as wtp
 
+from dessert.metrics import NULL_METRICS, Metrics, Progress
+
+from .cache import SqliteWikitextCache, WikitextCache
+from .page import WikiPage
+
 
 class WikiSource:
+    # Most titles MediaWiki accepts in one query
+    MAX_BATCH_SIZE = 50
 
-    def __init__(self):
-        session = requests.Session()
-        session.headers.update({
-            "User-Agent": "dessertFetcher/0.1.0",
-            "Accept-Encoding": "gzip"
-        })
+    def __init__(self, concurrency: int = 1, max_retries: int = 5, cache: WikitextCache = None,
+                 api_url: str = "https://en.wikipedia.org/w/api.php", session: requests.Session = None,
+                 metrics: Metrics = None, max_response_size: int = 8 * 1024 * 1024):
+        # api_url can point to any MediaWiki API, e.g. a local FakeMediaWiki for load testing
+        # session is the HTTP transport: anything with a requests.Session compatible get() works
+        # metrics collects the HTTP request and cache counters, nothing is collected by default
+        # max_response_size is the expected content size limit of one API response
+        #   ($wgAPIMaxResultSize, 8 MiB in Wikipedia). It's lowered automatically if the
+        #   server cuts the responses earlier.
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                "User-Agent": "dessertFetcher/0.1.0",
+                "Accept-Encoding": "gzip"
+            })
+            # Keep enough pooled keep-alive connections around for every worker thread
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
         self._s = session
+        self._api_url = api_url
         self._wiki_request_count = 0
+        self._concurrency = max(concurrency, 1)
+        self._max_retries = max_retries
+        self._lock = threading.Lock()
+        self._cache = cache or SqliteWikitextCache()
+        self._metrics = metrics or NULL_METRICS
+        self._response_size = max_response_size
+        self._page_size = None
+        # Requested title -> canonical title of the pages got so far, on top of the cache aliases
+        self._aliases = {}
 
-    def _request_raw_wikitext(self, page_titles: [str]) -> [(str, wtp.WikiText)]:
-        cache_path = Path("wikitext")
-        wts = []
-        titles = page_titles[:]
-
-        # Create wikitext cache folder if needed
+    @staticmethod
+    def _retry_delay(r: requests.Response, attempt: int) -> float:
+        # Honor the Retry-After header if the server sent one, otherwise back off exponentially
+        retry_after = r.headers.get("Retry-After")
         try:
-            os.mkdir("wikitext")
-        except FileExistsError:
-            pass
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return float(2 ** attempt)
+
+    def _api_request(self, params: dict) -> dict:
+        # Make a MediaWiki API request using the pooled session
+        # Backs off and retries when the server is rate limiting us (HTTP 429) or when
+        # the replication lag is over our "maxlag" limit.
+        # See https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+        attempt = 0
+        while True:
+            with self._lock:
+                self._wiki_request_count += 1
+
+            with self._metrics.timer("http_request"):
+                r = self._s.get(self._api_url, params=params)
+            self._metrics.inc("http_requests")
+            self._metrics.inc("http_bytes", len(r.content))
+            if r.status_code in (429, 503) and attempt < self._max_retries:
+                self._metrics.inc("http_retries")
+                time.sleep(self._retry_delay(r, attempt))
+                attempt += 1
+                continue
+            r.raise_for_status()
+
+            j = r.json()
+            if j.get("error", {}).get("code") == "maxlag" and attempt < self._max_retries:
+                self._metrics.inc("http_retries")
+                time.sleep(self._retry_delay(r, attempt))
+                attempt += 1
+                continue
+            if "error" in j:
+                raise Exception("MediaWiki API error: %s" % j["error"].get("info", j["error"]))
+            return j
 
-        # Check wikitext cache
+    def _api_query(self, params: dict) -> (dict, int):
+        # Make a query and follow the "continue" tokens until the batch is complete
+        # MediaWiki leaves the rest of the pages to follow-up requests when a response would
+        # grow too large. The partial results are merged into one "query" object: the pages by
+        # title (the revisions of a page can arrive in a later response than the page itself),
+        # the normalizations and redirects as they are.
+        # Returns the merged query and the number of responses it took.
+        # See https://www.mediawiki.org/wiki/API:Continue
+        params = dict(params)
+        pages = {}
+        normalized = {}
+        redirects = {}
+        responses = 0
+        while True:
+            j = self._api_request(params)
+            responses += 1
+            query = j.get("query") or {}
+            for entry in query.get("normalized") or []:
+                normalized[entry["from"]] = entry
+            for entry in query.get("redirects") or []:
+                redirects[entry["from"]] = entry
+            for page in query.get("pages") or []:
+                merged = pages.get(page["title"])
+                if merged is None:
+                    pages[page["title"]] = page
+                    continue
+                revisions = merged.get("revisions", []) + page.get("revisions", [])
+                merged.update(page)
+                if len(revisions) > 0:
+                    merged["revisions"] = revisions
+
+            if not self._continue(params, j):
+                break
+        return {
+            "pages": list(pages.values()),
+            "normalized": list(normalized.values()),
+            "redirects": list(redirects.values())
+        }, responses
+
+    def _continue(self, params: dict, j: dict) -> bool:
+        # Update params with the "continue" tokens of the response j
+        # Returns False if there's nothing to continue.
+        cont = j.get("continue")
+        if cont is None:
+            return False
+        if all(params.get(key) == value for key, value in cont.items()):
+            raise Exception("MediaWiki API continuation did not advance: %s" % cont)
+        params.update(cont)
+        self._metrics.inc("http_continuations")
+        return True
+
+    def _iter_api_list(self, params: dict, list_name: str) -> Iterator[dict]:
+        # Yield the items of a list query (e.g. list=categorymembers) response by response,
+        # following the continuations
+        params = dict(params)
+        while True:
+            j = self._api_request(params)
+            yield from (j.get("query") or {}).get(list_name) or []
+            if not self._continue(params, j):
+                return
+
+    def _batch_size(self) -> int:
+        # Number of titles to request at once
+        # As many as fit into one response on average, so long pages are fetched in smaller
+        # batches instead of needing several continuation requests per batch.
+        with self._lock:
+            if self._page_size is None:
+                return self.MAX_BATCH_SIZE
+            return max(1, min(self.MAX_BATCH_SIZE, int(self._response_size / self._page_size)))
+
+    def _update_batch_size(self, content_size: int, pages: int, responses: int):
+        with self._lock:
+            if pages > 0:
+                page_size = max(content_size / pages, 1.0)
+                if self._page_size is None:
+                    self._page_size = page_size
+                else:
+                    # Moving average, so one long page doesn't shrink all the following batches
+                    self._page_size = 0.8 * self._page_size + 0.2 * page_size
+            if responses > 1:
+                # The server cut the responses, every response but the last one was full
+                self._response_size = min(self._response_size, content_size / (responses - 0.5))
+
+    def _request_raw_wikitext(self, page_titles: [str], use_cache: bool = True) -> [(str, WikiPage)]:
+        wts = []
+
+        # Check wikitext cache, the whole batch is looked up at once
+        cached = self._cache.get_many(page_titles) if use_cache else {}
         for page in page_titles:
-            wt_path = cache_path / ("%s.txt" % quote(page))
-            if os.path.isfile(wt_path):
-                with open(wt_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    wts.append((page, wtp.parse(content)))
-                titles.remove(page)
+            if page in cached:
+                title, content = cached[page]
+                wts.append((title, WikiPage(title, content)))
+        with self._lock:
+            self._aliases.update((page, title) for page, (title, _) in cached.items() if page != title)
+        titles = [page for page in page_titles if page not in cached]
+        if use_cache:
+            self._metrics.inc("cache_hits", len(page_titles) - len(titles))
+            self._metrics.inc("cache_misses", len(titles))
 
         if len(titles) == 0:
             return wts
@@ -42,96 +194,146 @@ class WikiSource:
         # Request wikitext for the given pages
         # We request multiple pages at the same time to reduce request load to the
         # Wikipedia servers. See https://www.mediawiki.org/wiki/API:Etiquette
-        url = "https://en.wikipedia.org/w/api.php"
         params = {
             "action": "query",
             "format": "json",
             "titles": "|".join(titles),
             "prop": "revisions",
             "formatversion": "2",
-            "rvprop": "content",
+            "rvprop": "content|ids|timestamp",
             "rvslots": "*",
             "redirects": "1",
             "maxlag": "5"
         }
 
-        self._wiki_request_count += 1
-
-        r = requests.get(url, params=params)
-        r.raise_for_status()
+        query, responses = self._api_query(params)
 
-        j = r.json()
-
-        if not j["batchcomplete"]:
-            # This has not happened during development, so it's probably fine to not handle this
-            raise Exception("Batch not complete")
-
-        normalizations = j["query"].get("normalized") or []
-        redirects = j["query"].get("redirects") or []
+        # Resolve the requested titles to the canonical titles
+        # Normalization (e.g. "ice cream soda" -> "Ice cream soda") is applied first and
+        # the redirects (e.g. "Ice cream soda" -> "Ice cream float") after that.
+        normalizations = {entry["from"]: entry["to"] for entry in query["normalized"]}
+        redirects = {entry["from"]: entry["to"] for entry in query["redirects"]}
         orig_titles = {}
-        # Convert the redirect / normalization dicts to our own dict
-        # Example:
-        # {
-        #   "from": "Ice cream soda",
-        #   "to": "Ice cream float"
-        # }
-        # becomes:
-        # {
-        #   "Ice cream float": "Ice cream soda"
-        # }
-        for ls in [redirects, normalizations]:
-            for key, value in {entry["to"]: entry["from"] for entry in ls}.items():
-                orig_titles[key] = value
-
-        for page in j["query"]["pages"]:
-            if page.get("missing"):
+        for orig_title in titles:
+            title = normalizations.get(orig_title, orig_title)
+            title = redirects.get(title, title)
+            orig_titles.setdefault(title, []).append(orig_title)
+        with self._lock:
+            self._aliases.update((orig_title, title) for title, aliases in orig_titles.items()
+                                 for orig_title in aliases if orig_title != title)
+
+        to_cache = []
+        fetched = 0
+        content_size = 0
+        for page in query["pages"]:
+            if page.get("missing") or len(page.get("revisions") or []) == 0:
                 # We tried to get a page that does not exist, move to the next page
                 # TODO: Log
                 continue
             title = page["title"]
-            orig_title = orig_titles.get(title) or title
-            content = page["revisions"][0]["slots"]["main"]["content"]
-            # Parse the wikitext and add it to the list
-            wts.append((title, wtp.parse(content)))
-            # Store to naive filesystem cache
-            # The cache won't expire on its own, so the user must delete the cache folder to expire the cache
-            # The filename will be the URLEncoded version of the title
-            wt_path = cache_path / ("%s.txt" % quote(orig_title))
-            with open(wt_path, "w", encoding="utf-8") as f:
-                f.write(content)
+            revision = page["revisions"][0]
+            content = revision["slots"]["main"]["content"]
+            fetched += 1
+            content_size += len(content)
+            # Add the page to the list, the wikitext is parsed only when needed
+            wts.append((title, WikiPage(title, content)))
+            # Store to the cache under the canonical title, the requested titles become aliases
+            # The cache won't expire on its own, use refresh_cache() to update changed pages
+            for orig_title in orig_titles.get(title) or [title]:
+                to_cache.append((orig_title, title, content, revision["revid"], revision["timestamp"]))
+        self._cache.put_many(to_cache)
+        self._update_batch_size(content_size, fetched, responses)
 
+        # The API returns the pages in its own order, put them in the order of the requested
+        # titles so that the order doesn't depend on what was cached
+        # A page is placed at the first of the titles that lead to it.
+        positions = {}
+        for idx, page in enumerate(page_titles):
+            positions.setdefault(page, idx)
+        canonical_positions = {}
+        resolved = [(title, page) for page, (title, _) in cached.items()]
+        resolved += [(title, alias) for title, aliases in orig_titles.items() for alias in aliases]
+        for title, page in resolved:
+            canonical_positions[title] = min(positions[page], canonical_positions.get(title, len(page_titles)))
+        wts.sort(key=lambda wt: canonical_positions.get(wt[0], len(page_titles)))
         return wts
 
-    def _get_wikitext(self, page_title: str) -> wtp.WikiText:
+    def _get_wikitext(self, page_title: str) -> WikiPage:
         return self._request_raw_wikitext([page_title])[0][1]
 
-    def _get_multiple_wikitext(self, page_titles: [str]) -> [(str, wtp.WikiText)]:
+    def _next_batch(self, titles: Iterator[str], requested: set) -> [str]:
+        # Take the next batch of titles, skipping the titles whose page is already requested
+        # The titles are resolved through the known aliases, so e.g. a redirect to a page that
+        # is in an earlier batch is not requested (or read from the cache) again.
+        # requested holds the requested and canonical titles so far and is updated.
+        batch = []
+        duplicates = 0
+        # Request up to 50 pages at once (the maximum allowed by MediaWiki)
+        size = self._batch_size()
+        while len(batch) < size:
+            chunk = list(islice(titles, size - len(batch)))
+            if len(chunk) == 0:
+                break
+            aliases = self._cache.resolve(chunk)
+            with self._lock:
+                aliases.update((title, self._aliases[title]) for title in chunk if title in self._aliases)
+            for title in chunk:
+                canonical = aliases.get(title, title)
+                if title in requested or canonical in requested:
+                    duplicates += 1
+                    continue
+                requested.add(title)
+                requested.add(canonical)
+                batch.append(title)
+        self._metrics.inc("duplicate_titles", duplicates)
+        return batch
+
+    def _iter_multiple_wikitext(self, page_titles: Iterable[str],
+                                use_cache: bool = True) -> Iterator[List[Tuple[str, WikiPage]]]:
+        # Yields the pages batch by batch, in the order of the given titles
+        # Batches are requested concurrently (up to the concurrency limit) over the shared session.
+        # At most two batches per worker are in flight, so the titles can be a lazy iterator and
+        # the batches are handed out as soon as they arrive.
+        # Every page is yielded once, under its canonical title, even if several of the titles
+        # lead to it.
+        requested = set()
+        yielded = set()
+
+        def unique(pages: [(str, WikiPage)]) -> [(str, WikiPage)]:
+            # Redirects that were not known before the batch was requested are caught here
+            result = []
+            for title, page in pages:
+                if title not in yielded:
+                    yielded.add(title)
+                    result.append((title, page))
+            self._metrics.inc("duplicate_titles", len(pages) - len(result))
+            return result
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            pending = deque()
+            titles = iter(page_titles)
+            while True:
+                batch = self._next_batch(titles, requested)
+                if len(batch) == 0:
+                    break
+                pending.append(executor.submit(self._request_raw_wikitext, batch, use_cache))
+                if len(pending) >= self._concurrency * 2:
+                    yield unique(pending.popleft().result())
+            while len(pending) > 0:
+                yield unique(pending.popleft().result())
+
+    def _get_multiple_wikitext(self, page_titles: [str], use_cache: bool = True) -> [(str, WikiPage)]:
         print("Getting %d wiki pages" % len(page_titles))
-        work_items = []
         wikitexts = []
         got_count = 0
         total_count = len(page_titles)
         start_req_count = self._wiki_request_count
-        for title in page_titles:
-            work_items.append(title)
-            # Request 50 pages at once (the maximum allowed by MediaWiki)
-            if len(work_items) >= 50:
-                # Request pages
-                result = self._request_raw_wikitext(work_items)
+        with Progress() as progress:
+            for result in self._iter_multiple_wikitext(page_titles, use_cache):
                 wikitexts.extend(result)
                 got_count += len(result)
-                work_items = []
-                print("%d / %d (%.2f %%)"
-                      % (got_count, total_count, (float(got_count) / float(total_count) * 100.0)))
-        if len(work_items) > 0:
-            # Request pages
-            result = self._request_raw_wikitext(work_items)
-            wikitexts.extend(result)
-            got_count += len(result)
-            work_items = []
-            print("%d / %d (%.2f %%)"
-                  % (got_count, total_count, (float(got_count) / float(total_count) * 100.0)))
-        print()
+                progress.update("%d / %d (%.2f %%)"
+                                % (got_count, total_count, (float(got_count) / float(total_count) * 100.0)))
 
         end_req_count = self._wiki_request_count
         print("Made %d request(s) to Wikipedia" %
@@ -139,12 +341,83 @@ class WikiSource:
 
         return wikitexts
 
+    def _request_latest_revisions(self, page_titles: [str]) -> {str: int}:
+        # Request only the page info (no content) for the given pages
+        params = {
+            "action": "query",
+            "format": "json",
+            "titles": "|".join(page_titles),
+            "prop": "info",
+            "formatversion": "2",
+            "maxlag": "5"
+        }
+        query, _ = self._api_query(params)
+        return {page["title"]: page["lastrevid"] for page in query["pages"] if not page.get("missing")}
+
+    def refresh_cache(self, page_titles: [str]) -> [str]:
+        # Re-download the cached pages whose revision has changed since they were cached
+        # Only the latest revision IDs are requested for the cached pages, which is a lot
+        # cheaper than downloading the content again. Returns the refreshed titles.
+        cached = self._cache.get_revisions(page_titles)
+        cached_revids = {title: revid for title, revid, _ in cached.values()}
+        titles = list(cached_revids.keys())
+        print("Checking %d cached wiki pages for changes" % len(titles))
+        latest = {}
+        for i in range(0, len(titles), self.MAX_BATCH_SIZE):
+            latest.update(self._request_latest_revisions(titles[i:i+self.MAX_BATCH_SIZE]))
+        changed = [title for title, revid in latest.items() if revid != cached_revids.get(title)]
+        print("%d page(s) changed" % len(changed))
+        if len(changed) > 0:
+            self._get_multiple_wikitext(changed, use_cache=False)
+        return changed
+
+    def iter_category_members(self, categories: Iterable[str], max_depth: int = 1) -> Iterator[str]:
+        # Yield the titles of the articles in the given categories and their subcategories
+        # The category tree is crawled breadth-first down to max_depth levels of subcategories
+        # (0 = only the given categories). Every title is yielded once, as soon as the listing
+        # it's in arrives, so the titles can be fed straight to iter_dessert_wikitexts().
+        # See https://www.mediawiki.org/wiki/API:Categorymembers
+        pending = deque()
+        seen_categories = set()
+        for category in categories:
+            if not category.startswith("Category:"):
+                category = "Category:" + category
+            if category not in seen_categories:
+                seen_categories.add(category)
+                pending.append((category, 0))
+        seen_pages = set()
+        while len(pending) > 0:
+            category, depth = pending.popleft()
+            params = {
+                "action": "query",
+                "format": "json",
+                "list": "categorymembers",
+                "cmtitle": category,
+                "cmtype": "page|subcat",
+                "cmprop": "title|type",
+                # The maximum allowed for normal users
+                "cmlimit": "500",
+                "formatversion": "2",
+                "maxlag": "5"
+            }
+            for member in self._iter_api_list(params, "categorymembers"):
+                title = member["title"]
+                if member.get("type") == "subcat" or member.get("ns") == 14:
+                    if depth < max_depth and title not in seen_categories:
+                        seen_categories.add(title)
+                        pending.append((title, depth + 1))
+                elif member.get("ns", 0) == 0 and title not in seen_pages:
+                    seen_pages.add(title)
+                    yield title
+
     def get_dessert_list(self) -> [str]:
         dessert_page = self._get_wikitext("List of desserts")
 
         print("Parsing dessert list page")
         # Get section named "By type"
-        by_type = [s for s in dessert_page.sections if s.title == "By type"][0]
+        by_type = next((s for s in dessert_page.wikitext.sections if s.title == "By type"), None)
+        if by_type is None:
+            raise Exception("No \"By type\" section in the dessert list page, use categories instead")
         # Get all lists in the section
         lists = by_type.get_lists()
         # Flatten the lists
@@ -152,16 +425,21 @@ class WikiSource:
         for letter_list in lists:
             for item in letter_list.items:
                 # Parse page WikiLinks
-                link = wtp.parse(item).wikilinks[0]
+                links = wtp.parse(item).wikilinks
+                if len(links) == 0:
+                    continue
                 # Add the page title to the title list
-                dessert_pages.add(link.title)
+                dessert_pages.add(links[0].title)
 
         print("Found %d dessert pages" % len(dessert_pages))
 
         return list(dessert_pages)
 
-    def get_dessert_wikitext(self, page_title) -> wtp.WikiText:
+    def get_dessert_wikitext(self, page_title) -> WikiPage:
         return self._get_wikitext(page_title)
 
-    def get_dessert_wikitexts(self, page_titles: [str]) -> [(str, wtp.WikiText)]:
+    def get_dessert_wikitexts(self, page_titles: [str]) -> [(str, WikiPage)]:
         return self._get_multiple_wikitext(page_titles)
+
+    def iter_dessert_wikitexts(self, page_titles: Iterable[str]) -> Iterator[List[Tuple[str, WikiPage]]]:
+        return self._iter_multiple_wikitext(page_titles)
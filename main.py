@@ -1,29 +1,32 @@
-import nltk
-from nltk import ngrams
+import argparse
+import os
+import sys
 
-from dessert.nlp import IngredientProcessor
+from dessert.metrics import NULL_METRICS, Metrics, Progress
+from dessert.model import IngredientCorpus, write_corpus
+from dessert.nlp import IngredientProcessor, missing_resources, prefetch_resources
+from dessert.pipeline import DessertPipeline, ResultCache
+from dessert.query import IngredientIndex, QueryService, bigrams, jaccard
 from dessert.wiki import WikiSource, WikiParser
 
-lemma = nltk.wordnet.WordNetLemmatizer()
-
 
 def sim(word1, word2):
-    w1 = set(["".join(i) for i in ngrams(word1, 2)])
-    w2 = set(["".join(i) for i in ngrams(word2, 2)])
-    jaettava = w1.intersection(w2)
-    jakaja = w1.union(w2)
-    return len(jaettava) / len(jakaja)
+    return jaccard(bigrams(word1), bigrams(word2))
 
 
-def filterDessertByMandatoryIngredients(mandatoryIngredients, ingredients):
+def filterDessertByMandatoryIngredients(mandatoryIngredients, ingredients, lemmatize):
     # mandatoryIngredients, recipe must include all these ingredients to be returned
+    # This checks a single dessert, IngredientIndex answers the same question for the whole corpus.
+    # lemmatize should lowercase the name too, e.g. IngredientProcessor.lemmatize
+    # Work on a copy, the caller's list is left as is
+    mandatoryIngredients = list(mandatoryIngredients)
     if len(mandatoryIngredients) == 0:
         return True
     # haha nested for loop go brrrrrr
     for ingredient in ingredients:
-        for mandatoryIngredient in mandatoryIngredients:
+        for mandatoryIngredient in mandatoryIngredients[:]:
             # try using the ingredient name directly
-            if sim(lemma.lemmatize(ingredient.name.lower()), mandatoryIngredient.lower()) > 0.5:
+            if sim(lemmatize(ingredient.name), mandatoryIngredient.lower()) > 0.5:
                 mandatoryIngredients.remove(mandatoryIngredient)
                 if (len(mandatoryIngredients) == 0):
                     return True
@@ -31,10 +34,11 @@ def filterDessertByMandatoryIngredients(mandatoryIngredients, ingredients):
                 # check ingredient's ingredients
                 # Remove any non str-chars and tokenize word
                 for partIngredient in ingredient.ingredients:
-                    if sim(lemma.lemmatize(partIngredient.name.lower()), mandatoryIngredient.lower()) > 0.5:
+                    if sim(lemmatize(partIngredient.name), mandatoryIngredient.lower()) > 0.5:
                         mandatoryIngredients.remove(mandatoryIngredient)
                         if (len(mandatoryIngredients) == 0):
                             return True
+                        break
     return False
 
 
@@ -43,44 +47,136 @@ def getMandatoryIngredients():
 
 
 if __name__ == "__main__":
-    ws = WikiSource()
-    wp = WikiParser()
+    parser = argparse.ArgumentParser(description="Fetch desserts and their ingredients from Wikipedia")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="download the needed NLTK resources and exit")
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-download the cached pages that have changed in Wikipedia")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes for parsing (default: parse in the main process)")
+    parser.add_argument("--memo", metavar="PATH",
+                        help="load and save the normalization and lemma memos from/to this file")
+    parser.add_argument("--no-result-cache", action="store_true",
+                        help="parse every page again instead of using the cached parsing results")
+    parser.add_argument("--engine", choices=WikiParser.ENGINES, default="scanner",
+                        help="ingredient list parser engine (default: scanner)")
+    parser.add_argument("--category", action="append", metavar="NAME",
+                        help="crawl the desserts from this Wikipedia category and its subcategories instead of "
+                             "\"List of desserts\" (can be given several times, e.g. --category Desserts)")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="how many levels of subcategories to crawl (default: 2)")
+    parser.add_argument("--export", metavar="PATH",
+                        help="also write all desserts and their ingredients to a columnar corpus file")
+    parser.add_argument("--include", nargs="*", metavar="INGREDIENT",
+                        help="ingredients the desserts in list.txt must have (default: %s, none = all desserts)"
+                             % " ".join(getMandatoryIngredients()))
+    parser.add_argument("--exclude", nargs="*", default=[], metavar="INGREDIENT",
+                        help="ingredients the desserts in list.txt must not have")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="keep running and answer ingredient queries over HTTP, e.g. --serve 8081")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write timings and counters to this file, in Prometheus text format if it ends "
+                             "with .prom and as JSON otherwise")
+    args = parser.parse_args()
+
+    if args.prefetch:
+        sys.exit(0 if prefetch_resources() else 1)
+    # Check the NLTK resources locally before doing anything else
+    missing = missing_resources()
+    if len(missing) > 0:
+        print("Missing NLTK resources: %s" % ", ".join(missing))
+        print("Run \"python main.py --prefetch\" to download them")
+        sys.exit(1)
+
+    metrics = Metrics() if args.metrics else NULL_METRICS
+    ws = WikiSource(concurrency=4, metrics=metrics)
+    wp = WikiParser(engine=args.engine)
     ip = IngredientProcessor()
+    if args.memo and os.path.isfile(args.memo):
+        if not ip.load_memo(args.memo):
+            print("Ignoring the memos in %s, they were saved by another version" % args.memo)
+
+    if args.refresh:
+        ws.refresh_cache(["List of desserts"])
 
-    # Get list of all available desserts
-    dessert_pages = ws.get_dessert_list()
+    if args.category:
+        # The titles are streamed to the pipeline while the category tree is crawled
+        dessert_pages = ws.iter_category_members(args.category, max_depth=args.depth)
+    else:
+        # Get list of all available desserts
+        dessert_pages = ws.get_dessert_list()
 
-    # Get each dessert as wikitext
-    wikitexts = ws.get_dessert_wikitexts(dessert_pages)
+    if args.refresh or args.serve:
+        # The titles are needed again
+        dessert_pages = list(dessert_pages)
+    if args.refresh:
+        ws.refresh_cache(dessert_pages)
+
+    # Fetch, parse and normalize the desserts as a stream
+    result_cache = None
+    if not args.no_result_cache:
+        result_cache = ResultCache(DessertPipeline.results_version(wp, ip))
+    pipeline = DessertPipeline(ws, wp, ip, workers=args.workers, result_cache=result_cache, metrics=metrics)
+    # Index the ingredients of all desserts for the mandatory ingredient query
+    index = IngredientIndex(key=ip.lemmatize)
+    corpus = IngredientCorpus() if args.export else None
 
     parsed_count = 0
-    total_desserts = len(dessert_pages)
-    last_line_len = 0
-    with open("list.txt", "w", encoding="utf-8") as f:
-        # Parse ingredients from the wikitext
-        for title, wt in wikitexts:
-            # Print some status info
-            line = "Parsing ingredients: %s" % title
-            print(" " * last_line_len, end="\r")
-            last_line_len = len(line)
-            print(line, end="\r")
-
-            # Parse ingredients
-            ingredients = wp.get_dessert_ingredients(wt)
-            if len(ingredients) > 0:
-                # Try to process ingredients (normalize names)
-                normalized_ingredients = ip.normalize_ingredients(ingredients)
-                # Comment this "if" and unindent the rows below it by four spaces to include all ingredients to the "list.txt"
-                if filterDessertByMandatoryIngredients(getMandatoryIngredients(), normalized_ingredients):
-                    f.write("\n")
-                    f.write("%s:\n" % title)
-                    for i in normalized_ingredients:
-                        f.write("- %s\n" % i.name)
+    total_desserts = 0
+    # The status line is redrawn by a background thread a few times per second
+    with Progress() as progress:
+        for title, normalized_ingredients in pipeline.run(dessert_pages):
+            progress.update("Parsing ingredients: %s" % title)
+            total_desserts += 1
+
+            if len(normalized_ingredients) > 0:
+                index.add(title, normalized_ingredients)
+                if corpus is not None:
+                    corpus.add(title, normalized_ingredients)
                 parsed_count += 1
-    print()
+
+    include = args.include if args.include is not None else getMandatoryIngredients()
+    with metrics.timer("filter"):
+        # Use getMandatoryIngredients() = [] to include all ingredients to the "list.txt"
+        desserts = index.query(include, exclude=args.exclude)
+    with open("list.txt", "w", encoding="utf-8") as f:
+        for title, normalized_ingredients in desserts:
+            f.write("\n")
+            f.write("%s:\n" % title)
+            for i in normalized_ingredients:
+                f.write("- %s\n" % i.name)
+
+    if corpus is not None:
+        write_corpus(corpus, args.export)
+        print("Exported %d ingredient rows to %s" % (len(corpus), args.export))
+
+    if args.memo:
+        ip.save_memo(args.memo)
+
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.to_prometheus() if args.metrics.endswith(".prom") else metrics.to_json())
 
     print("Got ingredients for %d desserts (%d / %d, %.2f %%)"
           % (parsed_count,
              parsed_count,
              total_desserts,
-             (float(parsed_count) / float(total_desserts) * 100.0)))
+             (float(parsed_count) / float(max(total_desserts, 1)) * 100.0)))
+
+    if args.serve:
+        def load_index():
+            # Everything comes from the caches unless pages are missing from them
+            new_index = IngredientIndex(key=ip.lemmatize)
+            new_index.add_all((title, ingredients) for title, ingredients in pipeline.run(dessert_pages)
+                              if len(ingredients) > 0)
+            return new_index
+
+        host, _, port = args.serve.rpartition(":")
+        # Reload when the wikitext cache changes, e.g. after "main.py --refresh" in another terminal
+        service = QueryService(load_index, watch=["wikitext.db"], host=host or "127.0.0.1", port=int(port),
+                               index=index)
+        print("Serving queries at %s/query?include=milk,almond&exclude=egg" % service.url)
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            pass